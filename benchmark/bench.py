@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the transliteration pipeline
+
+load        loading a rule file, parsed (cold) and from the compiled rule cache (warm)
+lpm         RulesManager._longest_prefix_match() at every position of the phonetics in the corpora
+to_hans     RulesManager.to_hans() on the corpora with its memo caches cleared, and with them warm
+end2end     RulesManager.transliterate() with espeak replaced by benchmark/fake_espeak.py, and without the override
+            dictionaries, so that every word goes through espeak and the rules
+
+No espeak is needed. Words/sec, p50/p99 latency per word and peak memory (by tracemalloc) are reported.
+Results are compared with benchmark/baseline.json, the exit code is 1 if any of them regresses. The baseline depends on
+the machine, so it is not committed. Results of benchmarks missing from it are saved into it, e.g. at the first run.
+
+    python benchmark/bench.py                  # run and compare with the baseline
+    python benchmark/bench.py --save-baseline  # run and save the results as the new baseline
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from ppat import pespeak, ppat  # noqa: E402
+from ppat.pespeak import EspeakProcessManager  # noqa: E402
+from ppat.ppat import RulesManager  # noqa: E402
+
+CORPORA_DIR = os.path.join(BENCHMARK_DIR, 'corpora')
+
+BASELINE_PATH = os.path.join(BENCHMARK_DIR, 'baseline.json')
+
+FAKE_ESPEAK_PATH = os.path.join(BENCHMARK_DIR, 'fake_espeak.py')
+
+# A result regresses if its words/sec drops, or its p50 latency or peak memory grows, by more than this ratio
+DEFAULT_TOLERANCE = 0.3
+
+
+def load_corpus(language):
+    """
+    :return: list<tuple(word, phonetics)>
+    """
+    with open(os.path.join(CORPORA_DIR, language + '.tsv'), encoding='utf8') as f:
+        return [tuple(line.rstrip('\n').split('\t')) for line in f if line.strip() and not line.startswith('#')]
+
+
+def get_languages():
+    return sorted(os.path.splitext(file_name)[0] for file_name in os.listdir(CORPORA_DIR)
+                  if file_name.endswith('.tsv'))
+
+
+def use_fake_espeak():
+    command = '{} {}'.format(sys.executable, FAKE_ESPEAK_PATH)
+    pespeak.ESPEAK_INTERACT_COMMAND = command + ' --ipa -q -v {}'
+    pespeak.ESPEAK_VERSION_COMMAND = command + ' --version'
+    pespeak.ESPEAK_VOICES_COMMAND = command + ' --voices'
+    pespeak.DEBUG = False
+    pespeak.__SUPPORTED_LANGUAGES__.clear()
+    pespeak.__SENTINEL_IPA__.clear()
+    EspeakProcessManager.ipa_cache = None  # Every word goes to the espeak process
+
+
+def measure(run, items, repeat):
+    """
+    Call run(item) for every item, repeat times, then once more with tracemalloc on
+    :return: dict: words_per_sec, p50_us, p99_us, peak_kib
+    """
+    latencies = []
+    gc.collect()
+    total_start = time.perf_counter()
+    for _ in range(repeat):
+        for item in items:
+            start = time.perf_counter()
+            run(item)
+            latencies.append(time.perf_counter() - start)
+    total = time.perf_counter() - total_start
+    tracemalloc.start()
+    for item in items:
+        run(item)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    latencies.sort()
+    return {'words_per_sec': round(len(latencies) / total, 1),
+            'p50_us': round(statistics.median(latencies) * 1e6, 2),
+            'p99_us': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1e6, 2),
+            'peak_kib': round(peak / 1024, 1)}
+
+
+def bench_load(language, repeat):
+    cache_dir = tempfile.mkdtemp()
+    rule_cache_dir, ppat.RULE_CACHE_DIR = ppat.RULE_CACHE_DIR, cache_dir
+    try:
+        def load_cold(_):
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            RulesManager().get_rule(language)
+
+        def load_warm(_):
+            RulesManager().get_rule(language)
+
+        return {'load_cold': measure(load_cold, [None], repeat), 'load_warm': measure(load_warm, [None], repeat)}
+    finally:
+        ppat.RULE_CACHE_DIR = rule_cache_dir
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def bench_lpm(language, corpus, repeat):
+    rule_manager = RulesManager()
+    context = rule_manager.get_match_context(language, 'people')
+
+    def lpm(phonetics):
+        for start in range(len(phonetics)):
+            rule_manager._longest_prefix_match(context, 'vowels', phonetics, start)
+            rule_manager._longest_prefix_match(context, 'consonants', phonetics, start)
+
+    return {'lpm': measure(lpm, [phonetics for word, phonetics in corpus], repeat)}
+
+
+def bench_to_hans(language, corpus, repeat):
+    rule_manager = RulesManager()
+    rule_manager.get_rule(language)
+
+    def to_hans_cold(phonetics):
+        rule_manager.hans_cache.clear()
+        rule_manager.segment_cache.clear()
+        rule_manager.to_hans(phonetics, language, 'people')
+
+    def to_hans_warm(phonetics):
+        rule_manager.to_hans(phonetics, language, 'people')
+
+    phonetics_list = [phonetics for word, phonetics in corpus]
+    return {'to_hans_cold': measure(to_hans_cold, phonetics_list, repeat),
+            'to_hans_warm': measure(to_hans_warm, phonetics_list, repeat)}
+
+
+def bench_end2end(language, corpus, repeat):
+    rule_manager = RulesManager()
+    rule_manager.get_rule(language)
+    rule_manager.lexicons[language] = None  # Words of the corpora are in the dictionaries
+
+    def transliterate(word):
+        rule_manager.hans_cache.clear()
+        rule_manager.segment_cache.clear()
+        rule_manager.transliterate(word, language)
+
+    return {'end2end': measure(transliterate, [word for word, phonetics in corpus], repeat)}
+
+
+def run(languages, repeat):
+    """
+    :return: dict{"<benchmark> <language>": dict of measure()}
+    """
+    results = {}
+    for language in languages:
+        corpus = load_corpus(language)
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            language_results = bench_load(language, max(1, repeat // 10))
+            language_results.update(bench_lpm(language, corpus, repeat))
+            language_results.update(bench_to_hans(language, corpus, repeat))
+            language_results.update(bench_end2end(language, corpus, max(1, repeat // 10)))
+        for name, result in language_results.items():
+            results['{} {}'.format(name, language)] = result
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: list<str>: regressions
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if result['words_per_sec'] < base['words_per_sec'] * (1 - tolerance):
+            regressions.append('{}: {} words/sec, baseline {}'.format(name, result['words_per_sec'],
+                                                                      base['words_per_sec']))
+        for k in ('p50_us', 'peak_kib'):
+            if result[k] > base[k] * (1 + tolerance):
+                regressions.append('{}: {} {}, baseline {}'.format(name, k, result[k], base[k]))
+    return regressions
+
+
+def print_results(results, baseline):
+    print('{:<22}{:>14}{:>12}{:>12}{:>12}{:>10}'.format('benchmark', 'words/sec', 'p50(us)', 'p99(us)',
+                                                      'peak(KiB)', 'vs base'))
+    for name, result in sorted(results.items()):
+        change = ''
+        if name in baseline and baseline[name]['words_per_sec']:
+            change = '{:+.0%}'.format(result['words_per_sec'] / baseline[name]['words_per_sec'] - 1)
+        print('{:<22}{:>14}{:>12}{:>12}{:>12}{:>10}'.format(name, result['words_per_sec'], result['p50_us'],
+                                                          result['p99_us'], result['peak_kib'], change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the transliteration pipeline')
+    parser.add_argument('-l', '--languages', nargs='+', default=get_languages(),
+                        help='Default: all languages in benchmark/corpora.')
+    parser.add_argument('-r', '--repeat', type=int, default=20, help='Runs over a corpus. Default: 20.')
+    parser.add_argument('-t', '--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Allowed ratio of regression. Default: {}.'.format(DEFAULT_TOLERANCE))
+    parser.add_argument('--baseline', default=BASELINE_PATH,
+                        help='Default: benchmark/baseline.json, created at the first run.')
+    parser.add_argument('--save-baseline', action='store_true', help='Save all the results as the baseline.')
+    args = parser.parse_args()
+
+    use_fake_espeak()
+    results = run(args.languages, args.repeat)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf8') as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    regressions = [] if args.save_baseline else compare(results, baseline, args.tolerance)
+    saved = {name: result for name, result in results.items() if args.save_baseline or name not in baseline}
+    if saved:
+        baseline.update(saved)
+        with open(args.baseline, 'w', encoding='utf8') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('{} result(s) saved to the baseline {}'.format(len(saved), args.baseline))
+    if regressions:
+        print('\n{} regression(s):'.format(len(regressions)))
+        for regression in regressions:
+            print('  ' + regression)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
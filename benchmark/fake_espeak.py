@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+A fake espeak for benchmarks, so that espeak does not need to be built.
+
+It answers "--voices" and "--version" like espeak, and "--ipa -q -v <voice>" by looking words up in
+corpora/<voice>.tsv, one answer per input line. Words not in the corpus are answered in lower case.
+"""
+import os
+import sys
+
+CORPORA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpora')
+
+VOICES = [('de', 'german'), ('en-us', 'english-us'), ('es', 'spanish'), ('fr', 'french'), ('it', 'italian'),
+          ('pt', 'portugal')]
+
+
+def load_corpus(voice):
+    path = os.path.join(CORPORA_DIR, voice + '.tsv')
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf8') as f:
+        return dict(line.rstrip('\n').split('\t') for line in f if line.strip() and not line.startswith('#'))
+
+
+def main(args):
+    if '--version' in args:
+        print('eSpeak text-to-speech: 1.48.15  04.Mar.14  Data at: fake')
+        return
+    if '--voices' in args:
+        print('Pty Language Age/Gender VoiceName          File          Other Languages')
+        for code, name in VOICES:
+            print(' 5  {:<14} M  {:<18} {}'.format(code, name, code))
+        return
+    corpus = load_corpus(args[args.index('-v') + 1] if '-v' in args else 'en-us')
+    for line in sys.stdin:
+        word = line.strip()
+        if word:
+            # espeak marks stresses, which are removed by ppat
+            sys.stdout.write('ˈ' + corpus.get(word, word.lower()) + '\n')
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,312 @@
+"""
+Phonetics backends, selected by method names in the .to_phonetics section of rule files
+
+copy:           just copy
+lowercase:      lower case all chars when copy
+espeak:         the bundled libespeak in process if it can be loaded, otherwise an espeak interactive process
+libespeak:      libespeak in process, through ctypes. The one installed in the OS if none is bundled.
+espeak-process: an espeak interactive process, through pexpect
+
+A method name not registered here is looked up in the "language_code.py" script of the rule file instead.
+"""
+import ctypes
+import ctypes.util
+import os
+import threading
+from collections import OrderedDict
+
+from .pespeak import get_supported_languages, EspeakError, EspeakProcessManager
+
+ESPEAK_INSTALL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'espeak', 'espeak.install')
+
+# Tried in order, then the libraries found in the OS if they are allowed, see get_libespeak()
+LIBESPEAK_PATHS = [os.path.join(ESPEAK_INSTALL_DIR, 'lib', 'libespeak-ng.so'),
+                   os.path.join(ESPEAK_INSTALL_DIR, 'lib', 'libespeak.so')]
+
+# Constants in speak_lib.h
+_AUDIO_OUTPUT_SYNCHRONOUS = 2
+_espeakCHARS_UTF8 = 1
+_PHONEMES_IPA = 0x10  # phonememode of espeak_TextToPhonemes() asks for IPA by bits 4-7 in espeak 1.48
+_PHONEMES_IPA_NG = 0x02  # and by bit 1 in espeak-ng
+_EE_OK = 0
+
+# !!! DO NOT CALL IT !!! Use "get_libespeak()" instead
+__LIBESPEAK__ = {}  # dict{whether libraries of the OS are allowed: LibEspeak, or False if none can be loaded}
+
+espeak_engine = EspeakProcessManager()
+
+# dict{method name: backend class}
+BACKENDS = {}
+
+
+def register_backend(name):
+    """
+    Register a PhoneticsBackend subclass, so that rule files can use it by name in .to_phonetics section
+    """
+    def decorator(cls):
+        BACKENDS[name] = cls
+        return cls
+    return decorator
+
+
+def get_backend(name, language_code):
+    """
+    :param name: method name in .to_phonetics section
+    :param language_code:
+    :return: PhoneticsBackend, or None if no backend is registered by the name
+    """
+    if name not in BACKENDS:
+        return None
+    return BACKENDS[name].create(language_code)
+
+
+def decode_espeak_output(phonetics):
+    """
+    Decode an output of espeak, replace stresses.
+    :param phonetics: bytes
+    :return: str
+    """
+    return phonetics.decode('utf8').strip().translate(str.maketrans({'ˈ': None, 'ˌ': None}))
+
+
+def espeak(word, language_code):
+    """
+    Call EspeakProcessManager.to_ipa_for_language(), replace stresses.
+    :param word:
+    :param language_code:
+    :return:
+    """
+    assert language_code in get_supported_languages()
+
+    return decode_espeak_output(espeak_engine.to_ipa_for_language(word, language_code))
+
+
+def espeak_batch(words, language_code):
+    """
+    Call EspeakProcessManager.to_ipa_batch(), replace stresses.
+    :param words: list<str>
+    :param language_code:
+    :return: list<str>: None for a word which espeak did not answer
+    """
+    assert language_code in get_supported_languages()
+
+    return [None if phonetics is None else decode_espeak_output(phonetics)
+            for phonetics in espeak_engine.to_ipa_batch(words, language_code)]
+
+
+def espeak_for_languages(word, language_codes):
+    """
+    Call EspeakProcessManager.to_ipa_for_languages(), espeak processes of the languages are asked at the same time.
+    :param word:
+    :param language_codes: list<str>: not repeated languages
+    :return: dict{language_code: phonetics}
+    """
+    return {language_code: decode_espeak_output(phonetics)
+            for language_code, phonetics in espeak_engine.to_ipa_for_languages(word, language_codes).items()}
+
+
+async def espeak_async(word, language_code, espeak_pool):
+    """
+    Call AsyncEspeakPool.to_ipa(), replace stresses.
+    :param word:
+    :param language_code:
+    :param espeak_pool: AsyncEspeakPool
+    :return: str, or None if espeak did not answer the word
+    """
+    assert language_code in get_supported_languages()
+
+    try:
+        return decode_espeak_output(await espeak_pool.to_ipa(word, language_code))
+    except EspeakError:
+        return None
+
+
+class LibEspeak(object):
+    """
+    libespeak loaded by ctypes. libespeak keeps the current voice globally, so calls are serialized.
+    """
+
+    def __init__(self, library):
+        self._lib = library
+        self._lib.espeak_Initialize.restype = ctypes.c_int
+        self._lib.espeak_Initialize.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+        self._lib.espeak_SetVoiceByName.restype = ctypes.c_int
+        self._lib.espeak_SetVoiceByName.argtypes = [ctypes.c_char_p]
+        self._lib.espeak_TextToPhonemes.restype = ctypes.c_char_p
+        self._lib.espeak_TextToPhonemes.argtypes = [ctypes.POINTER(ctypes.c_void_p), ctypes.c_int, ctypes.c_int]
+        self._lib.espeak_Info.restype = ctypes.c_char_p
+        self._lib.espeak_Info.argtypes = [ctypes.c_void_p]
+        data_path = os.path.join(ESPEAK_INSTALL_DIR, 'share')
+        sample_rate = self._lib.espeak_Initialize(_AUDIO_OUTPUT_SYNCHRONOUS, 0,
+                                                  data_path.encode('utf8') if os.path.isdir(data_path) else None, 0)
+        if sample_rate < 0:
+            raise OSError('Cannot initialize libespeak')
+        # libespeak-ng exports the API of espeak 1.48 as well, but reads phonememode differently
+        self._phonemes_ipa = _PHONEMES_IPA_NG if hasattr(library, 'espeak_ng_InitializePath') else _PHONEMES_IPA
+        self._lock = threading.Lock()
+        self._voice = None
+        # Key of the IPA cache, as the library may not be the same version as the espeak program
+        self.version = 'libespeak ' + self._lib.espeak_Info(None).decode('utf8')
+
+    def to_ipa(self, word, language_code):
+        """
+        :param word:
+        :param language_code:
+        :return: bytes: phonetics with stresses, the same as the output of espeak --ipa
+        """
+        with self._lock:
+            if self._voice != language_code:
+                if self._lib.espeak_SetVoiceByName(language_code.encode('utf8')) != _EE_OK:
+                    raise ValueError('libespeak has no voice "{}"'.format(language_code))
+                self._voice = language_code
+            text = ctypes.create_string_buffer(word.encode('utf8'))
+            text_pointer = ctypes.c_void_p(ctypes.addressof(text))
+            clauses = []
+            # espeak_TextToPhonemes() translates a clause at a time, and sets text_pointer to NULL at the end
+            while text_pointer.value:
+                clauses.append(self._lib.espeak_TextToPhonemes(ctypes.byref(text_pointer), _espeakCHARS_UTF8,
+                                                               self._phonemes_ipa) or b'')
+            return b' '.join(clauses)
+
+
+def _system_libespeak_paths():
+    # find_library() runs ldconfig or gcc in subprocesses, so it is called only if no bundled library can be loaded
+    for name in ('espeak-ng', 'espeak'):
+        path = ctypes.util.find_library(name)
+        if path:
+            yield path
+
+
+def _load_libespeak(paths):
+    for path in paths:
+        try:
+            return LibEspeak(ctypes.CDLL(path))
+        except (OSError, AttributeError):
+            continue
+    return False
+
+
+def get_libespeak(system=False):
+    """
+    Load libespeak at first call, the result is kept even if no libespeak can be loaded
+    :param system: whether a libespeak installed in the OS is loaded if no bundled one can be. It may be another version
+    than the espeak program, so it is only used when asked for by name.
+    :return: LibEspeak, or None if no libespeak can be loaded
+    """
+    if False not in __LIBESPEAK__:
+        __LIBESPEAK__[False] = _load_libespeak(path for path in LIBESPEAK_PATHS if os.path.exists(path))
+    if system and True not in __LIBESPEAK__:
+        __LIBESPEAK__[True] = __LIBESPEAK__[False] or _load_libespeak(_system_libespeak_paths())
+    return __LIBESPEAK__[system] or None
+
+
+class PhoneticsBackend(object):
+    """
+    Base class of phonetics backends. Subclasses implement to_phonetics() at least.
+    """
+
+    def __init__(self, language_code):
+        self.language_code = language_code
+
+    @classmethod
+    def create(cls, language_code):
+        return cls(language_code)
+
+    def to_phonetics(self, word):
+        raise NotImplementedError
+
+    def to_phonetics_batch(self, words):
+        """
+        :param words: list<str>
+        :return: list<str>
+        """
+        return [self.to_phonetics(word) for word in words]
+
+    async def to_phonetics_async(self, word, espeak_pool):
+        """
+        :param word:
+        :param espeak_pool: AsyncEspeakPool
+        :return: str
+        """
+        return self.to_phonetics(word)
+
+
+@register_backend('copy')
+class CopyBackend(PhoneticsBackend):
+
+    def to_phonetics(self, word):
+        return word
+
+
+@register_backend('lowercase')
+class LowercaseBackend(PhoneticsBackend):
+
+    def to_phonetics(self, word):
+        return word.lower()
+
+
+@register_backend('espeak-process')
+class EspeakProcessBackend(PhoneticsBackend):
+    """
+    Talk to an espeak interactive process of EspeakProcessManager
+    """
+
+    def __init__(self, language_code):
+        assert language_code in get_supported_languages(), \
+            'Cannot use espeak for language "{}"'.format(language_code)
+        super(EspeakProcessBackend, self).__init__(language_code)
+
+    def to_phonetics(self, word):
+        return espeak(word, self.language_code)
+
+    def to_phonetics_batch(self, words):
+        return espeak_batch(words, self.language_code)
+
+    async def to_phonetics_async(self, word, espeak_pool):
+        return await espeak_async(word, self.language_code, espeak_pool)
+
+
+@register_backend('libespeak')
+class LibEspeakBackend(PhoneticsBackend):
+    """
+    Call libespeak in process, no subprocess or pseudo-terminal is involved. Answers are kept in
+    EspeakProcessManager.ipa_cache, by the version of the library.
+    """
+
+    def __init__(self, language_code, system=True):
+        """
+        :param language_code:
+        :param system: see get_libespeak()
+        """
+        self.libespeak = get_libespeak(system)
+        assert self.libespeak is not None, 'Cannot load libespeak'
+        super(LibEspeakBackend, self).__init__(language_code)
+
+    def to_phonetics(self, word):
+        return self.to_phonetics_batch([word])[0]
+
+    def to_phonetics_batch(self, words):
+        ipa_cache = EspeakProcessManager.ipa_cache
+        cached = {}
+        if ipa_cache is not None:
+            cached = ipa_cache.get_many(self.libespeak.version, self.language_code, words)
+        missed = [word for word in OrderedDict.fromkeys(words) if word not in cached]
+        for word in missed:
+            cached[word] = self.libespeak.to_ipa(word, self.language_code)
+        if ipa_cache is not None and missed:
+            ipa_cache.put_many(self.libespeak.version, self.language_code, [(word, cached[word]) for word in missed],
+                               flush=len(missed) > 1)
+        return [decode_espeak_output(cached[word]) for word in words]
+
+
+@register_backend('espeak')
+class EspeakBackend(PhoneticsBackend):
+    """
+    The bundled libespeak if it can be loaded, otherwise an espeak interactive process
+    """
+
+    @classmethod
+    def create(cls, language_code):
+        if get_libespeak() is not None:
+            return LibEspeakBackend(language_code, system=False)
+        return EspeakProcessBackend(language_code)
@@ -0,0 +1,163 @@
+"""
+Caches used by PPAT
+"""
+import atexit
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+CACHE_DIR = os.environ.get('PPAT_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'ppat'))
+
+IPA_CACHE_PATH = os.path.join(CACHE_DIR, 'ipa.sqlite3')
+
+# Max number of items kept in memory by IPACache
+IPA_CACHE_MEMORY_SIZE = 65536
+
+# IPACache commits to disk once there are so many new items
+IPA_CACHE_FLUSH_SIZE = 256
+
+
+class LRUCache(object):
+    """
+    A bounded dict that drops the least recently used item when it is full
+    """
+
+    def __init__(self, maxsize):
+        assert isinstance(maxsize, int) and maxsize > 0
+
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def remove_if(self, predicate):
+        """
+        Remove the items whose keys satisfy predicate(key)
+        """
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class IPACache(object):
+    """
+    Persistent cache of espeak outputs keyed by (espeak version, voice, word), with an in-memory LRU on top.
+
+    The SQLite file is opened on first use. If it cannot be opened, the cache works in memory only.
+    Because the espeak version is part of the key, items are invalidated by themselves when espeak is rebuilt.
+    """
+
+    def __init__(self, path=IPA_CACHE_PATH, memory_size=IPA_CACHE_MEMORY_SIZE):
+        self.path = path
+        self.memory = LRUCache(memory_size)
+        self._connection = None
+        self._connected = False
+        self._pending = []
+        self._lock = threading.RLock()
+
+    def _connect(self):
+        if self._connected:
+            return self._connection
+        self._connected = True
+        try:
+            if self.path != ':memory:':
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute('CREATE TABLE IF NOT EXISTS ipa '
+                               '(version TEXT, voice TEXT, word TEXT, ipa BLOB, PRIMARY KEY (version, voice, word))')
+            connection.commit()
+        except (OSError, sqlite3.Error):
+            return None
+        self._connection = connection
+        atexit.register(self.close)
+        return self._connection
+
+    def get(self, version, voice, word):
+        """
+        :return: bytes or None if missed
+        """
+        return self.get_many(version, voice, [word]).get(word)
+
+    def get_many(self, version, voice, words):
+        """
+        :return: dict{word: bytes}, missed words are not included
+        """
+        result = {}
+        missed = []
+        for word in words:
+            ipa = self.memory.get((version, voice, word))
+            if ipa is None:
+                missed.append(word)
+            else:
+                result[word] = ipa
+        if not missed:
+            return result
+        with self._lock:
+            connection = self._connect()
+            if connection is None:
+                return result
+            # Keep the number of SQL variables under SQLite's default limit 999
+            for i in range(0, len(missed), 900):
+                chunk = missed[i: i + 900]
+                rows = connection.execute('SELECT word, ipa FROM ipa WHERE version = ? AND voice = ? AND word IN ({})'
+                                          .format(','.join('?' * len(chunk))), [version, voice] + chunk)
+                for word, ipa in rows:
+                    result[word] = bytes(ipa)
+                    self.memory.put((version, voice, word), bytes(ipa))
+        return result
+
+    def put(self, version, voice, word, ipa):
+        self.put_many(version, voice, [(word, ipa)], flush=False)
+
+    def put_many(self, version, voice, items, flush=True):
+        """
+        :param items: list<tuple(word, bytes)>
+        :param flush: commit to disk at once
+        """
+        for word, ipa in items:
+            self.memory.put((version, voice, word), ipa)
+        with self._lock:
+            self._pending.extend((version, voice, word, ipa) for word, ipa in items)
+            if flush or len(self._pending) >= IPA_CACHE_FLUSH_SIZE:
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            connection = self._connect()
+            if connection is not None and self._pending:
+                connection.executemany('INSERT OR REPLACE INTO ipa VALUES (?, ?, ?, ?)', self._pending)
+                connection.commit()
+            self._pending = []
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self.flush()
+                self._connection.close()
+            self._connection = None
+            self._connected = False
@@ -0,0 +1,160 @@
+"""
+Override dictionaries of names which have standard Chinese forms, consulted before espeak and the rule tables
+
+A "language_code.dict" file in the rules directory has a name per line:
+
+    London = 伦敦
+    Charles = 查理 | 查尔斯
+
+The first hans is for people and the second one for places, one hans is for both. Names are matched case-insensitively.
+Lines starting with "//" are comments.
+
+A dictionary is compiled into a sorted lookup file in CACHE_DIR and memory-mapped, so that it is neither parsed nor
+loaded into memory again by each process. It is compiled again when the dictionary file changes.
+"""
+import hashlib
+import mmap
+import os
+import struct
+
+from .cache import CACHE_DIR
+
+LEXICON_CACHE_DIR = os.path.join(CACHE_DIR, 'lexicons')
+
+# Bump it whenever the layout of the compiled lookup file changes
+LEXICON_VERSION = 1
+
+# Layout: header, (count + 1) offsets of records, records sorted by key. A record is key \0 people \0 places in UTF-8.
+_MAGIC = b'PPATLEX'
+_HEADER = struct.Struct('<7sB40sI')  # magic, version, sha1 digest of the dictionary file, count
+_OFFSET = struct.Struct('<I')
+
+
+def get_lexicon_cache_path(language):
+    return os.path.join(LEXICON_CACHE_DIR, language + '.lex')
+
+
+def normalize(word):
+    return word.casefold()
+
+
+def parse_dict(dict_file):
+    """
+    :param dict_file: a text file object
+    :return: dict{normalized word: tuple(hans_people, hans_places)}
+    """
+    entries = {}
+    line_number = 0
+    for line in dict_file:
+        line_number += 1
+        line = line.strip()
+        if line == '' or line.startswith('//'):
+            continue
+        assert '=' in line, 'Expect "word = hans" at line {} in file : {}'.format(line_number, dict_file.name)
+        word, hans = (i.strip() for i in line.split('=', 1))
+        hans = [i.strip() for i in hans.split('|')]
+        assert word and ' ' not in word and 1 <= len(hans) <= 2 and all(hans), \
+            'Invalid entry "{}" at line {} in file : {}'.format(line, line_number, dict_file.name)
+        entries[normalize(word)] = (hans[0], hans[-1])
+    return entries
+
+
+def compile_lexicon(entries, digest):
+    """
+    :param entries: dict of parse_dict()
+    :param digest: str: sha1 hex digest of the dictionary file
+    :return: bytes: the lookup file
+    """
+    records = [b'\0'.join(i.encode('utf8') for i in (key,) + entries[key]) for key in entries]
+    records.sort(key=lambda record: record.split(b'\0', 1)[0])
+    header = _HEADER.pack(_MAGIC, LEXICON_VERSION, digest.encode('ascii'), len(records))
+    offsets = []
+    offset = _HEADER.size + _OFFSET.size * (len(records) + 1)
+    for record in records:
+        offsets.append(_OFFSET.pack(offset))
+        offset += len(record)
+    offsets.append(_OFFSET.pack(offset))
+    return b''.join([header] + offsets + records)
+
+
+class Lexicon(object):
+    """
+    Binary search over a compiled lookup file, either memory-mapped or in bytes
+    """
+
+    def __init__(self, data):
+        """
+        :param data: mmap or bytes of compile_lexicon()
+        """
+        magic, version, digest, self.count = _HEADER.unpack_from(data, 0)
+        assert magic == _MAGIC and version == LEXICON_VERSION
+        self.digest = digest.decode('ascii')
+        self._data = data
+
+    def _offset(self, i):
+        return _OFFSET.unpack_from(self._data, _HEADER.size + _OFFSET.size * i)[0]
+
+    def _record(self, i):
+        return self._data[self._offset(i): self._offset(i + 1)].split(b'\0')
+
+    def get(self, word):
+        """
+        :param word:
+        :return: tuple(hans_people, hans_places), or None if the word is not in the dictionary
+        """
+        key = normalize(word).encode('utf8')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            record = self._record(middle)
+            if record[0] < key:
+                low = middle + 1
+            elif record[0] > key:
+                high = middle
+            else:
+                return record[1].decode('utf8'), record[2].decode('utf8')
+        return None
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+
+
+def _map(path):
+    with open(path, 'rb') as f:
+        return Lexicon(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def load_lexicon(dict_path, language):
+    """
+    Load the compiled lookup file of a dictionary, compile it first if it is missing or out of date.
+    :param dict_path: path of the .dict file
+    :param language:
+    :return: Lexicon, or None if the dictionary file does not exist
+    """
+    if not os.path.exists(dict_path):
+        return None
+    with open(dict_path, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    cache_path = get_lexicon_cache_path(language)
+    try:
+        lexicon = _map(cache_path)
+        if lexicon.digest == digest:
+            return lexicon
+        lexicon.close()
+    except Exception:
+        pass  # No lookup file, or an unreadable one. Compile the dictionary.
+    with open(dict_path, 'r', encoding='utf8') as dict_file:
+        data = compile_lexicon(parse_dict(dict_file), digest)
+    try:
+        os.makedirs(LEXICON_CACHE_DIR, exist_ok=True)
+        tmp_path = cache_path + '.{}.tmp'.format(os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, cache_path)
+        return _map(cache_path)
+    except OSError:
+        return Lexicon(data)  # The lookup file is optional
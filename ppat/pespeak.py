@@ -1,14 +1,24 @@
 """
 Espeak's Python Binding
 """
+import asyncio
 import os
 import platform
+import pty
 import subprocess
+import sys
+import threading
+import time
+import tty
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from functools import total_ordering
 
 import pexpect
 
+from .cache import IPACache
+from .profiling import profiler
+
 DEBUG = True
 
 ESPEAK_EXEC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'espeak', 'espeak.install', 'bin', 'espeak')
@@ -22,27 +32,54 @@ ESPEAK_VOICES_COMMAND = ESPEAK_EXEC_PATH + ' --voices'
 # !!! DO NOT CALL IT !!! Use "get_supported_languages()" instead
 __SUPPORTED_LANGUAGES__ = {}
 
+# !!! DO NOT CALL IT !!! Use "get_espeak_version()" instead
+__ESPEAK_VERSION__ = None
+
 # Max subprocess number, should be greater than the number of items in ALWAYS_ONLINE_LANGUAGES
 MAX_CHILDREN_NUMBER = 12
 
 # Languages that usually be used, will not be closed by EspeakProcessManager if the number of process reaches its limit
 ALWAYS_ONLINE_LANGUAGES = ['en-us']
 
+# Which process is closed when the number of processes reaches its limit, 'lru' or 'lfu'
+EVICTION_POLICY = 'lru'
+
+# Processes not used for this many seconds are closed, except the always-online ones. None for never.
+IDLE_TIMEOUT = 300
+
+# Seconds to wait for an answer of espeak, the process is considered hung and respawned after that
+ESPEAK_TIMEOUT = 3
+
+# Seconds added to ESPEAK_TIMEOUT per word to wait for a non-interactive espeak process over a batch of words
+ESPEAK_BATCH_TIMEOUT_PER_WORD = 0.01
+
+# Number of espeak processes per language in an AsyncEspeakPool
+ASYNC_CHILDREN_PER_LANGUAGE = 2
+
+# Max number of words written to an AsyncEspeakProcess but not answered yet. Callers wait when it is reached.
+ASYNC_MAX_PENDING = 64
+
+# A word written after every word sent to espeak in a batch. Answers are mapped back to words by the answer to it,
+# so that a word answered by no line or by several lines does not shift the answers of the following words.
+ESPEAK_SENTINEL = 'ppatsentinel'
+
+# !!! DO NOT CALL IT !!! Use "get_sentinel_ipa()" instead
+__SENTINEL_IPA__ = {}
+
 
 def subprocess_run_by_python_version(command):
     """
-    Do subprocess.run() properly in python3.5(6) and 3.7.
+    Do subprocess.run() properly in python3.5(6) and 3.7+.
     See https://stackoverflow.com/questions/53209127/subprocess-unexpected-keyword-argument-capture-output
     """
-    python_version = platform.python_version()
-    if python_version.startswith('3.5') or python_version.startswith('3.6'):
+    if sys.version_info < (3, 5):
+        print('Invalid python version {}. You MUST have python3.5 or above installed.'.format(platform.python_version()))
+        exit(0)
+    elif sys.version_info < (3, 7):
         from subprocess import PIPE
         return subprocess.run(command.split(' ')+['>>', '/dev/null'], stdout=PIPE, stderr=PIPE).stdout.decode('utf8')
-    elif python_version.startswith('3.7'):
-        return subprocess.run(command, shell=True, capture_output=True).stdout.decode('utf8')
     else:
-        print('Invalid python version {}. You MUST have python3.5, 3.6 or 3.7 installed.')
-        exit(0)
+        return subprocess.run(command, shell=True, capture_output=True).stdout.decode('utf8')
 
 
 def get_supported_languages():
@@ -65,7 +102,6 @@ def get_supported_languages():
 
 
 assert len(ALWAYS_ONLINE_LANGUAGES) < MAX_CHILDREN_NUMBER
-assert all([i in get_supported_languages().keys() for i in ALWAYS_ONLINE_LANGUAGES])
 
 
 def print_supported_languages():
@@ -75,7 +111,77 @@ def print_supported_languages():
 
 
 def get_espeak_version():
-    return subprocess_run_by_python_version(ESPEAK_VERSION_COMMAND)
+    global __ESPEAK_VERSION__
+    if __ESPEAK_VERSION__ is None:
+        __ESPEAK_VERSION__ = subprocess_run_by_python_version(ESPEAK_VERSION_COMMAND).strip()
+    return __ESPEAK_VERSION__
+
+
+def _run_espeak(language, text, timeout=ESPEAK_TIMEOUT):
+    """
+    Run one non-interactive espeak process over text
+    :param language:
+    :param text: str: one word per line
+    :param timeout: seconds, espeak is killed and subprocess.TimeoutExpired is raised after that
+    :return: list<bytes>: non-empty output lines
+    """
+    assert language in get_supported_languages().keys()
+
+    command = ESPEAK_INTERACT_COMMAND.format(language).split(' ')
+    output = subprocess.run(command, input=text.encode('utf8'), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            timeout=timeout).stdout
+    return [line.strip() for line in output.splitlines() if line.strip()]
+
+
+def get_sentinel_ipa(language):
+    """
+    Get the answer of espeak to ESPEAK_SENTINEL, espeak is asked once per language
+    :param language:
+    :return: bytes
+    """
+    if language not in __SENTINEL_IPA__:
+        lines = _run_espeak(language, ESPEAK_SENTINEL + '\n')
+        assert len(lines) == 1, 'Unexpected answer of espeak to "{}": {}'.format(ESPEAK_SENTINEL, lines)
+        __SENTINEL_IPA__[language] = lines[0]
+    return __SENTINEL_IPA__[language]
+
+
+def split_answers(lines, sentinel_ipa):
+    """
+    Split output lines of espeak for words each followed by ESPEAK_SENTINEL into the answers of the words
+    :param lines: iterable<bytes>: stripped output lines
+    :param sentinel_ipa: bytes: see get_sentinel_ipa()
+    :return: list<bytes>: answers, lines of an answer are joined by spaces. b'' for a word answered by no line.
+    """
+    answers = []
+    answer = []
+    for line in lines:
+        if line == sentinel_ipa:
+            answers.append(b' '.join(answer))
+            answer = []
+        elif line:
+            answer.append(line)
+    return answers
+
+
+def _run_espeak_batch(language, words):
+    """
+    Run one non-interactive espeak process over all the words, one word per line followed by ESPEAK_SENTINEL
+    :param language:
+    :param words: list<str>
+    :return: list<bytes>: answers of the words, fewer than words if espeak exited or timed out before answering all
+    of them
+    """
+    start = time.perf_counter()
+    try:
+        sentinel_ipa = get_sentinel_ipa(language)
+        lines = _run_espeak(language, ''.join(word + '\n' + ESPEAK_SENTINEL + '\n' for word in words),
+                            ESPEAK_TIMEOUT + len(words) * ESPEAK_BATCH_TIMEOUT_PER_WORD)
+    except subprocess.TimeoutExpired:
+        return []
+    if profiler.enabled:
+        profiler.add_time((language, 'espeak io'), time.perf_counter() - start, len(words))
+    return split_answers(lines, sentinel_ipa)
 
 
 def _spawn_espeak(language):
@@ -86,13 +192,16 @@ def _spawn_espeak(language):
     """
     assert language in get_supported_languages().keys()
 
-    return pexpect.spawn(ESPEAK_INTERACT_COMMAND.format(language))
+    child = pexpect.spawn(ESPEAK_INTERACT_COMMAND.format(language))
+    # pexpect sleeps 50ms before every send by default, which is longer than espeak takes to answer
+    child.delaybeforesend = None
+    return child
 
 
-@total_ordering
 class EspeakProcess(object):
     """
-    An espeak interactive process
+    An espeak interactive process. Calls from different threads are serialized.
+    A child which exited or hung is killed and respawned, unless the process has been retired by its pool.
     """
 
     def __init__(self, language):
@@ -102,54 +211,372 @@ class EspeakProcess(object):
             self._create_time = datetime.now()
         self.language = language
         self._calls = 0
+        self._respawns = 0
+        self._retired = False
+        self._lock = threading.Lock()
         self._child = _spawn_espeak(language)
-
-    def __eq__(self, other):
-        return self._calls == other.calls
-
-    def __lt__(self, other):
-        return self._calls < other.calls
+        self.last_used = time.monotonic()
 
     def __del__(self):
         self.close()
 
+    def _respawn(self):
+        self._child.close(force=True)
+        self._child = _spawn_espeak(self.language)
+        self._respawns += 1
+
     def to_ipa(self, word):
         assert ' ' not in word
 
-        if self._child.closed:
-            self._child = _spawn_espeak(self.language)
+        with self._lock:
+            self.last_used = time.monotonic()
+            if self._child.closed:
+                if self._retired:
+                    raise pexpect.EOF('espeak process of "{}" has been retired'.format(self.language))
+                self._child = _spawn_espeak(self.language)
+            with profiler.stage('espeak io', self.language):
+                for retry in (False, True):
+                    try:
+                        self._child.sendline(word)
+                        self._child.expect('\r\n', timeout=ESPEAK_TIMEOUT)
+                        self._child.expect('\r\n', timeout=ESPEAK_TIMEOUT)
+                        break
+                    except (pexpect.TIMEOUT, pexpect.EOF):
+                        # The child hung or exited, answers of it cannot be trusted any more
+                        if self._retired:
+                            self._child.close(force=True)
+                            raise
+                        self._respawn()
+                        if retry:
+                            raise
+            self._calls += 1
+            return self._child.before
+
+    def check(self):
+        """
+        Respawn the child if it has exited
+        :return: bool: True if it was alive
+        """
+        with self._lock:
+            if self._retired or self._child.closed or self._child.isalive():
+                return True
+            self._respawn()
+            return False
 
-        self._child.sendline(word)
-        self._child.expect('\r\n', timeout=3)
-        self._child.expect('\r\n', timeout=3)
-        self._calls += 1
-        return self._child.before
+    def retire(self):
+        """
+        Never respawn the child again. Called by the pool before closing the process, so that a thread still holding
+        the process does not leave a child the pool does not know about.
+        """
+        self._retired = True
+
+    @property
+    def retired(self):
+        return self._retired
 
     @property
     def calls(self):
         return self._calls
 
+    @property
+    def respawns(self):
+        return self._respawns
+
     @property
     def closed(self):
         return self._child.closed
 
     def close(self):
+        if not hasattr(self, '_child') or self._child.closed:
+            return
         if DEBUG:
             period = (datetime.now() - self._create_time).seconds
             print('Process of language "{}" has lived for {} second(s) and been called {} time(s)'
-                  .format(self.language, period, self._calls))
+                  .format(self.language, period, self._calls), file=sys.stderr)
+
+        with self._lock:
+            self._child.close(force=True)
+
+
+class _LRUOrder(object):
+    """
+    Keys ordered from the least recently used one, every operation is O(1)
+    """
+
+    def __init__(self):
+        self._keys = OrderedDict()
+
+    def add(self, key):
+        self._keys[key] = None
+
+    def touch(self, key):
+        self._keys.move_to_end(key)
+
+    def remove(self, key):
+        self._keys.pop(key, None)
+
+    def pop(self):
+        return self._keys.popitem(last=False)[0]
+
+
+class _LFUOrder(object):
+    """
+    Keys ordered from the least frequently used one, ties are broken by recency. Every operation is O(1).
+    """
+
+    def __init__(self):
+        self._frequencies = {}  # dict{key: frequency}
+        self._buckets = {}  # dict{frequency: OrderedDict{key: None}}, keys of a frequency from the least recent one
+        self._min_frequency = 0
+
+    def _unlink(self, key):
+        frequency = self._frequencies.pop(key)
+        bucket = self._buckets[frequency]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[frequency]
+        return frequency
+
+    def add(self, key):
+        self._frequencies[key] = 1
+        self._buckets.setdefault(1, OrderedDict())[key] = None
+        self._min_frequency = 1
+
+    def touch(self, key):
+        frequency = self._unlink(key)
+        if frequency == self._min_frequency and frequency not in self._buckets:
+            self._min_frequency = frequency + 1
+        self._frequencies[key] = frequency + 1
+        self._buckets.setdefault(frequency + 1, OrderedDict())[key] = None
+
+    def remove(self, key):
+        if key in self._frequencies:
+            self._unlink(key)
+
+    def pop(self):
+        if self._min_frequency not in self._buckets:
+            # Only after remove(), which is rare
+            self._min_frequency = min(self._buckets.keys())
+        key = next(iter(self._buckets[self._min_frequency]))
+        self._unlink(key)
+        return key
+
+
+EVICTION_POLICIES = {'lru': _LRUOrder, 'lfu': _LFUOrder}
+
+
+class EspeakProcessPool(object):
+    """
+    One espeak process per language, at most max_children processes in total.
+
+    Processes of always_online_languages are never evicted or reaped. When the pool is full, the least recently (lru)
+    or the least frequently (lfu) used process of other languages is closed to make room for a new one.
+    Processes idle for more than idle_timeout seconds are closed by a daemon thread, which respawns exited children
+    as well. It is safe to share a pool across threads.
+    """
 
-        self._child.close()
+    def __init__(self, max_children=MAX_CHILDREN_NUMBER, always_online_languages=ALWAYS_ONLINE_LANGUAGES,
+                 idle_timeout=IDLE_TIMEOUT, policy=EVICTION_POLICY):
+        """
+        :param max_children: int
+        :param always_online_languages: list<str>
+        :param idle_timeout: seconds, None for never reaping idle processes
+        :param policy: 'lru' or 'lfu'
+        """
+        assert len(always_online_languages) < max_children
+        assert policy in EVICTION_POLICIES.keys()
+        assert idle_timeout is None or idle_timeout > 0
+
+        self.max_children = max_children
+        self.always_online_languages = frozenset(always_online_languages)
+        self.idle_timeout = idle_timeout
+        self.policy = policy
+        self._always_online_processes = {}
+        self._scalable_processes = {}
+        self._scalable_processes_limit = max_children - len(self.always_online_languages)
+        self._order = EVICTION_POLICIES[policy]()
+        self._lock = threading.Lock()
+        self._spawning = {}  # dict{language: threading.Event set when the process is spawned}
+        self._reaper = None
+        self._closed = threading.Event()
+        self.hits = 0
+        self.misses = 0
+        self.spawns = 0
+        self.evictions = 0
+        self.reaped = 0
+        self._respawns_of_closed = 0
+
+    def _retire_process(self, language):
+        """
+        Take the process of a language out of the pool, it is closed by the caller after releasing self._lock, as
+        closing waits for the answer the process is giving
+        :param language:
+        :return: EspeakProcess
+        """
+        process = self._scalable_processes.pop(language)
+        self._order.remove(language)
+        self._respawns_of_closed += process.respawns
+        process.retire()
+        return process
+
+    def get_process(self, language):
+        """
+        Get the espeak process of a language, spawn one if not exists
+        :param language:
+        :return: EspeakProcess
+        """
+        scalable = language not in self.always_online_languages
+        evicted = None
+        while True:
+            with self._lock:
+                processes = self._scalable_processes if scalable else self._always_online_processes
+                process = processes.get(language)
+                if process is not None:
+                    self.hits += 1
+                    if scalable:
+                        self._order.touch(language)
+                    return process
+                spawning = self._spawning.get(language)
+                if spawning is None:
+                    self.misses += 1
+                    # The slot is reserved, so that other languages are served while espeak is starting
+                    spawning = self._spawning[language] = threading.Event()
+                    reserved = len([i for i in self._spawning if i not in self.always_online_languages])
+                    # Slots being reserved cannot be evicted, the pool may be over the limit until they are filled
+                    if scalable and processes and len(processes) + reserved > self._scalable_processes_limit:
+                        evicted = self._retire_process(self._order.pop())
+                        self.evictions += 1
+                    break
+            # Another thread is spawning the process of the language
+            spawning.wait()
+        if evicted is not None:
+            evicted.close()
+        try:
+            process = EspeakProcess(language)
+        except BaseException:
+            with self._lock:
+                del self._spawning[language]
+                spawning.set()
+            raise
+        with self._lock:
+            del self._spawning[language]
+            spawning.set()
+            self.spawns += 1
+            processes = self._scalable_processes if scalable else self._always_online_processes
+            processes[language] = process
+            if scalable:
+                self._order.add(language)
+            self._start_reaper()
+        return process
+
+    def _start_reaper(self):
+        if self.idle_timeout is None or self._reaper is not None:
+            return
+        self._reaper = threading.Thread(target=self._reap_forever, name='espeak-reaper', daemon=True)
+        self._reaper.start()
+
+    def _reap_forever(self):
+        while not self._closed.wait(self.idle_timeout / 2):
+            self.reap_idle()
+            self.check()
+
+    def reap_idle(self):
+        """
+        Close the processes not used for idle_timeout seconds, except processes of always-online languages
+        :return: int: number of processes closed
+        """
+        if self.idle_timeout is None:
+            return 0
+        deadline = time.monotonic() - self.idle_timeout
+        with self._lock:
+            idle = [language for language, process in self._scalable_processes.items() if process.last_used < deadline]
+            retired = [self._retire_process(language) for language in idle]
+            self.reaped += len(retired)
+        for process in retired:
+            process.close()
+        return len(retired)
+
+    def check(self):
+        """
+        Health check, respawn the processes which have exited
+        :return: int: number of processes respawned
+        """
+        with self._lock:
+            processes = list(self._always_online_processes.values()) + list(self._scalable_processes.values())
+        return len([process for process in processes if not process.check()])
+
+    def stats(self):
+        """
+        :return: dict: counters of the pool
+        """
+        with self._lock:
+            processes = list(self._always_online_processes.values()) + list(self._scalable_processes.values())
+            return {'policy': self.policy,
+                    'children': len(processes),
+                    'max_children': self.max_children,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'spawns': self.spawns,
+                    'evictions': self.evictions,
+                    'reaped': self.reaped,
+                    'respawns': self._respawns_of_closed + sum(process.respawns for process in processes)}
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            processes = list(self._always_online_processes.values()) + list(self._scalable_processes.values())
+            for process in processes:
+                process.retire()
+            self._always_online_processes = {}
+            self._scalable_processes = {}
+            self._order = EVICTION_POLICIES[self.policy]()
+        for process in processes:
+            process.close()
 
 
 class EspeakProcessManager(object):
     """
-    A manager manages all espeak processes, for providing the best performance
+    A manager manages all espeak processes, for providing the best performance.
+    Processes are spawned on first use of their languages, nothing is spawned when imported.
+    It is safe to share a manager across threads.
     """
 
-    _always_online_processes = {i: EspeakProcess(i) for i in ALWAYS_ONLINE_LANGUAGES}
-    _scalable_processes_limit = MAX_CHILDREN_NUMBER - len(_always_online_processes.keys())
-    _scalable_processes = {}
+    pool = EspeakProcessPool()
+    ipa_cache = IPACache()  # Set to None to disable caching
+    _executor = None  # Threads talking to processes of several languages at a time, created on first use
+    _executor_lock = threading.Lock()
+
+    @classmethod
+    def _get_executor(cls):
+        with cls._executor_lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(MAX_CHILDREN_NUMBER)
+            return cls._executor
+
+    @classmethod
+    def configure(cls, **kwargs):
+        """
+        Replace the process pool of all managers, the processes of the old pool are closed.
+        See EspeakProcessPool for the arguments.
+        """
+        old_pool, cls.pool = cls.pool, EspeakProcessPool(**kwargs)
+        old_pool.close()
+
+    def _get_process(self, language):
+        return self.pool.get_process(language)
+
+    def _to_ipa(self, word, language):
+        process = self._get_process(language)
+        try:
+            return process.to_ipa(word)
+        except pexpect.EOF:
+            if not process.retired:
+                raise
+            # Evicted by another thread before it answered, ask the process the pool has now
+            return self._get_process(language).to_ipa(word)
+
+    def stats(self):
+        return self.pool.stats()
 
     def to_ipa_for_language(self, word, language):
         """
@@ -163,6 +590,41 @@ class EspeakProcessManager(object):
 
         return self.to_ipa_for_languages(word, [language])[language]
 
+    def to_ipa_batch(self, words, language):
+        """
+        Get IPA of many words for a certain language at a time, costs one espeak process exchange per batch
+        :param words: list<str>: every word should not contain any spaces
+        :param language:
+        :return: list<bytes>: phonetics, in the same order as words. None for a word which espeak did not answer.
+        """
+        assert isinstance(words, list) and all([isinstance(i, str) and not set(i) & {' ', '\n'} for i in words])
+        assert isinstance(language, str) and language in get_supported_languages()
+
+        if not words:
+            return []
+        cached = {}
+        if self.ipa_cache is not None:
+            cached = self.ipa_cache.get_many(get_espeak_version(), language, words)
+        missed = list(OrderedDict.fromkeys(word for word in words if word not in cached))
+        if missed:
+            # The answer to ESPEAK_SENTINEL itself would be taken for the end of an answer
+            batch = [word for word in missed if word.casefold() != ESPEAK_SENTINEL]
+            answers = dict(zip(batch, _run_espeak_batch(language, batch))) if batch else {}
+            # The words after espeak exited or timed out, if any, are asked one by one
+            result = [answers[word] if word in answers else self._to_ipa_or_none(word, language) for word in missed]
+            result = [ipa or None for ipa in result]
+            if self.ipa_cache is not None:
+                self.ipa_cache.put_many(get_espeak_version(), language,
+                                        [(word, ipa) for word, ipa in zip(missed, result) if ipa is not None])
+            cached.update(zip(missed, result))
+        return [cached[word] for word in words]
+
+    def _to_ipa_or_none(self, word, language):
+        try:
+            return self.to_ipa_for_language(word, language)
+        except (pexpect.TIMEOUT, pexpect.EOF):
+            return None  # Failed the word only, instead of the whole batch
+
     def to_ipa_for_languages(self, word, languages):
         """
         Get IPA for several languages at a time
@@ -172,26 +634,255 @@ class EspeakProcessManager(object):
         """
         assert isinstance(word, str) and ' ' not in word
         assert isinstance(languages, list) and all([i in get_supported_languages().keys() for i in languages]) \
-            and languages[1:] == languages[:-1]
+            and len(set(languages)) == len(languages)
 
         result = {}
+        missed = []
         for language in languages:
-            if language in self._always_online_processes.keys():
-                result[language] = self._always_online_processes[language].to_ipa(word)
-            elif language in self._scalable_processes.keys():
-                result[language] = self._scalable_processes[language].to_ipa(word)
-            else:
-                # create a new espeak process
-                new_process = EspeakProcess(language)
-                result[language] = new_process.to_ipa(word)
-                if len(self._scalable_processes.keys()) >= self._scalable_processes_limit:
-                    # Start of Algorithm
-                    tmp_min_item = self._scalable_processes.popitem()
-                    for k, v in self._scalable_processes.items():
-                        if v < tmp_min_item[1]:
-                            tmp_min_item = (k, v)
-                    # End of algorithm
-                    self._scalable_processes[tmp_min_item[0]] = tmp_min_item[1]
-                    self._scalable_processes.pop(tmp_min_item[0])
-                self._scalable_processes[language] = new_process
+            if self.ipa_cache is not None:
+                ipa = self.ipa_cache.get(get_espeak_version(), language, word)
+                if ipa is not None:
+                    result[language] = ipa
+                    continue
+            missed.append(language)
+        if len(missed) > 1:
+            # Processes of different languages answer at the same time
+            ipas = self._get_executor().map(lambda language: self._to_ipa(word, language), missed)
+        else:
+            ipas = [self._to_ipa(word, language) for language in missed]
+        for language, ipa in zip(missed, ipas):
+            result[language] = ipa
+            if self.ipa_cache is not None:
+                self.ipa_cache.put(get_espeak_version(), language, word, ipa)
         return result
+
+
+class EspeakError(Exception):
+    """
+    An asyncio espeak process did not answer a word: it gave no answer, hung or exited
+    """
+
+
+class AsyncEspeakProcess(object):
+    """
+    An espeak interactive process driven by asyncio.
+
+    Requests are pipelined: words are written to its stdin without waiting for the previous answers. ESPEAK_SENTINEL
+    is written after every word, and answers are read back up to the answer to it, in the same order as the words.
+    At most max_pending words are in flight at a time. If a word is not answered in ESPEAK_TIMEOUT seconds, the child
+    is killed and all the words in flight fail, the pool spawns a new process in its place.
+    """
+
+    def __init__(self, language, max_pending=ASYNC_MAX_PENDING):
+        assert language in get_supported_languages().keys()
+        assert isinstance(max_pending, int) and max_pending > 0
+
+        self.language = language
+        self.max_pending = max_pending
+        self._process = None
+        self._reader = None
+        self._read_task = None
+        self._killed = False
+        self._sentinel_ipa = None  # Answer of the child to ESPEAK_SENTINEL
+        self._pending = None  # asyncio.Queue of futures waiting for answers, in the order of words written
+
+    async def start(self):
+        # espeak buffers its output if stdout is a pipe, so it writes to a pseudo-terminal which flushes every line.
+        # The terminal is set to raw mode to keep the output as it is.
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        try:
+            self._process = await asyncio.create_subprocess_exec(*ESPEAK_INTERACT_COMMAND.format(self.language).split(' '),
+                                                                 stdin=subprocess.PIPE, stdout=slave,
+                                                                 stderr=subprocess.DEVNULL)
+        finally:
+            os.close(slave)
+        loop = asyncio.get_event_loop()
+        self._reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(self._reader), os.fdopen(master, 'rb', 0))
+        self._pending = asyncio.Queue(self.max_pending)
+        self._process.stdin.write(ESPEAK_SENTINEL.encode('utf8') + b'\n')
+        try:
+            self._sentinel_ipa = await asyncio.wait_for(self._read_line(), ESPEAK_TIMEOUT)
+        except (asyncio.TimeoutError, OSError):
+            self._process.kill()
+            raise EspeakError('espeak process of "{}" did not start'.format(self.language))
+        self._read_task = asyncio.ensure_future(self._read_answers())
+
+    async def _read_line(self):
+        """
+        :return: bytes: the next non-empty line, b'' if espeak exited
+        """
+        while True:
+            line = await self._reader.readline()
+            if not line or line.strip():
+                return line.strip()
+
+    async def _read_answers(self):
+        answer = []
+        try:
+            while True:
+                line = await self._read_line()
+                if not line:
+                    break
+                if line != self._sentinel_ipa:
+                    answer.append(line)  # A word may be answered by several lines
+                    continue
+                if self._pending.empty():
+                    answer = []
+                    continue  # The word has failed already, as the child was killed
+                future = self._pending.get_nowait()
+                if future.done():
+                    pass
+                elif answer:
+                    future.set_result(b' '.join(answer))
+                else:
+                    future.set_exception(EspeakError('espeak of "{}" gave no answer'.format(self.language)))
+                answer = []
+        except OSError:
+            pass  # Reading the terminal fails with EIO once espeak exits
+        finally:
+            self._fail_pending(EspeakError('espeak process of "{}" exited'.format(self.language)))
+
+    def _fail_pending(self, error):
+        while not self._pending.empty():
+            future = self._pending.get_nowait()
+            if not future.done():
+                future.set_exception(error)
+
+    def _kill(self, error):
+        """
+        Kill the child, answers of it cannot be trusted any more. All the words in flight fail with error.
+        """
+        self._killed = True
+        self._fail_pending(error)
+        if self._process.returncode is None:
+            self._process.kill()
+
+    @property
+    def pending(self):
+        return self._pending.qsize() if self._pending is not None else 0
+
+    @property
+    def closed(self):
+        return self._process is None or self._killed or self._process.returncode is not None \
+            or self._read_task.done()
+
+    async def to_ipa(self, word):
+        """
+        :param word: str: should not contain any spaces
+        :return: bytes: phonetics
+        :raise EspeakError: if the word was not answered
+        """
+        assert ' ' not in word and '\n' not in word
+
+        if word.casefold() == ESPEAK_SENTINEL:
+            raise EspeakError('"{}" is reserved'.format(word))
+        if self.closed:
+            raise EspeakError('espeak process of "{}" exited'.format(self.language))
+        future = asyncio.get_event_loop().create_future()
+        await self._pending.put(future)  # Wait here if too many words are in flight
+        if self.closed:
+            # Killed while waiting for room
+            self._fail_pending(EspeakError('espeak process of "{}" exited'.format(self.language)))
+            return await future
+        # No await between put() and write(), so that answers are in the same order as the futures in self._pending
+        self._process.stdin.write(word.encode('utf8') + b'\n' + ESPEAK_SENTINEL.encode('utf8') + b'\n')
+        try:
+            await self._process.stdin.drain()
+            return await asyncio.wait_for(asyncio.shield(future), ESPEAK_TIMEOUT)
+        except asyncio.TimeoutError:
+            future.cancel()
+            self._kill(EspeakError('espeak process of "{}" was killed as it hung'.format(self.language)))
+            raise EspeakError('espeak of "{}" did not answer in {} seconds'.format(self.language, ESPEAK_TIMEOUT))
+        except ConnectionError:
+            future.cancel()
+            self._kill(EspeakError('espeak process of "{}" exited'.format(self.language)))
+            raise EspeakError('espeak process of "{}" exited'.format(self.language))
+
+    async def close(self):
+        if self._process is None:
+            return
+        if self._process.returncode is None:
+            self._process.stdin.close()
+            try:
+                await asyncio.wait_for(self._process.wait(), 3)
+            except asyncio.TimeoutError:
+                self._process.kill()
+                await self._process.wait()
+        if self._read_task is not None:
+            await self._read_task
+
+
+class AsyncEspeakPool(object):
+    """
+    A pool of asyncio espeak processes, children_per_language processes for each language.
+
+    Processes are spawned on first use of their languages, and spawned again in place of the ones which exited or were
+    killed. A request goes to the process of its language with the fewest words in flight. Answers are cached in
+    EspeakProcessManager.ipa_cache as well.
+    """
+
+    def __init__(self, children_per_language=ASYNC_CHILDREN_PER_LANGUAGE, max_pending=ASYNC_MAX_PENDING):
+        assert isinstance(children_per_language, int) and children_per_language > 0
+
+        self.children_per_language = children_per_language
+        self.max_pending = max_pending
+        self._starting = {}  # dict{language: asyncio.Task}, spawning processes of a language
+        self._processes = {}  # dict{language: list<AsyncEspeakProcess>}
+
+    async def _spawn(self, language):
+        processes = self._processes.get(language, [])
+        alive = [process for process in processes if not process.closed]
+        spawned = [AsyncEspeakProcess(language, self.max_pending)
+                   for _ in range(self.children_per_language - len(alive))]
+        await asyncio.gather(*[process.start() for process in spawned])
+        self._processes[language] = alive + spawned
+        await asyncio.gather(*[process.close() for process in processes if process.closed])
+        return alive + spawned
+
+    async def _get_processes(self, language):
+        processes = self._processes.get(language)
+        if processes is not None and not any(process.closed for process in processes):
+            return processes
+        starting = self._starting.get(language)
+        if starting is None or starting.done():
+            # Not spawned yet, or some processes exited
+            starting = self._starting[language] = asyncio.ensure_future(self._spawn(language))
+        return await asyncio.shield(starting)
+
+    async def to_ipa(self, word, language):
+        """
+        Get IPA for a certain language
+        :param word: str: should not contain any spaces
+        :param language:
+        :return: bytes: phonetics
+        """
+        assert isinstance(word, str) and ' ' not in word
+        assert isinstance(language, str) and language in get_supported_languages()
+
+        ipa_cache = EspeakProcessManager.ipa_cache
+        if ipa_cache is not None:
+            ipa = ipa_cache.get(get_espeak_version(), language, word)
+            if ipa is not None:
+                return ipa
+        processes = await self._get_processes(language)
+        ipa = await min(processes, key=lambda process: process.pending).to_ipa(word)
+        if ipa_cache is not None:
+            ipa_cache.put(get_espeak_version(), language, word, ipa)
+        return ipa
+
+    async def to_ipa_batch(self, words, language):
+        """
+        Get IPA of many words for a certain language, all of them are in flight at a time
+        :param words: list<str>
+        :param language:
+        :return: list<bytes>: phonetics, in the same order as words
+        """
+        return list(await asyncio.gather(*[self.to_ipa(word, language) for word in words]))
+
+    async def close(self):
+        processes = [process for language_processes in self._processes.values() for process in language_processes]
+        self._processes = {}
+        self._starting = {}
+        await asyncio.gather(*[process.close() for process in processes])
@@ -2,26 +2,56 @@
 Main entry of PPAT
 """
 import _io
+import argparse
+import asyncio
+import contextlib
+import csv
+import hashlib
 import importlib
+import io
+import json
+import multiprocessing
 import os
+import pickle
 import re
 import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
 from functools import total_ordering
 
 from prettytable import PrettyTable
 
-from .pespeak import get_supported_languages, EspeakProcessManager
+from .backends import get_backend, espeak_for_languages, EspeakProcessBackend
+from .cache import CACHE_DIR, LRUCache
+from .lexicon import load_lexicon
+from .profiling import profiler
 
 try:
     import readline
 except:
     pass
 
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_constants
+    import sre_parse
+
 DEFAULT_ACTIVATED_LANGUAGES = ['en-us']
 
 RULES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rules')
 
-espeak_engine = EspeakProcessManager()
+RULE_CACHE_DIR = os.path.join(CACHE_DIR, 'rules')
+
+# Bump it whenever Rule, MatchRule or MatchTrie changes, so that the compiled rule cache is invalidated
+RULE_CACHE_VERSION = 10
+
+# Max number of (language, category, phonetics) => hans results memoized by a RulesManager
+HANS_CACHE_SIZE = 65536
+
+# Max number of segments, a consonant and a vowel usually, memoized by a RulesManager
+SEGMENT_CACHE_SIZE = 65536
 
 VERSION = 'v1.0'
 
@@ -41,7 +71,7 @@ Start loading rule files...
 """.format(VERSION)
 
 READY = """
-All rule files are loaded!
+Rule files of the activated languages are loaded! Others will be loaded on first use.
 Input names of people or places after the prompt.
 Type ":help" for more instructions.
 """
@@ -49,6 +79,7 @@ Type ":help" for more instructions.
 CONFIG = """
 :config languages <lang1> <lang2> ...  Set languages for transliterating.
 :config verbose <on|off>               Enable verbose mode for debugging messages.
+:config profile <on|off>               Print time spent per stage after each word.
 """
 
 HELP = """
@@ -57,6 +88,7 @@ Type a word without spaces to transliterate.
 :c\t:config                Get all available configurations.
 :c\t:config <key> <value>  Set a configuration.
 :l\t:lang                  Get all available languages.
+:r\t:reload [lang]         Reload the changed rule files, or the rule file of a language.
 :q\t:quit                  Quit PPAT.
 :h\t:help                  Print this message.
 
@@ -67,11 +99,88 @@ The default source languages are set to:
 BYE = """Bye.
 """
 
+# dict{output format: function(output_file) returning function(row)}, see register_batch_writer()
+BATCH_WRITERS = OrderedDict()
+
+# Names of the registered output formats, plugins registered later are included
+BATCH_FORMATS = BATCH_WRITERS.keys()
+
+# Lookarounds and word boundaries in <pre> or <post>, which look at the phonetics outside of what they match
+_LOOKAROUND = re.compile(r'\(\?<?[=!]|\\[bB]')
+
+# Keys of localisation files which are written without quotes
+_PLAIN_YML_KEY = re.compile(r'[\w.\-]+\Z')
+
+# Language key of the localisation files written in yml format. Chinese mods of Paradox games override l_english
+PARADOX_LOCALISATION_LANGUAGE = 'l_english'
+
+# Number of words sent to espeak at a time in batch mode
+BATCH_SIZE = 1000
+
+# Max number of words sent to a worker process at a time by transliterate_many()
+WORKER_CHUNK_SIZE = 500
+
+BATCH_FIELDS = ['word', 'language', 'phonetics_people', 'hans_people', 'phonetics_places', 'hans_places']
+
+# Phonetics of a word found in the override dictionary of its language, which is not sent to espeak
+LEXICON_PHONETICS = ''
+
+# Put in place of the phonetics which cannot be transliterated, when a partial result is asked for
+FALLBACK_MARKER = '?'
+
+FAILURE_FIELDS = ['word', 'language', 'category', 'phonetics', 'error']
+
+# A word which failed to be transliterated, see RulesManager.transliterate_batch()
+Failure = namedtuple('Failure', FAILURE_FIELDS)
+
+# A word transliterated into a language, see RulesManager.iter_transliterate()
+TransliterationResult = namedtuple('TransliterationResult', BATCH_FIELDS)
+
+
+class TransliterationError(Exception):
+    """
+    Part of the phonetics of a word cannot be transliterated by the rules of its language
+    """
+
+    def __init__(self, message, phonetics, language, category, position):
+        super(TransliterationError, self).__init__(message)
+        self.message = message
+        self.phonetics = phonetics
+        self.language = language
+        self.category = category
+        self.position = position
+
+    def __reduce__(self):
+        # Raised in worker processes and unpickled in the main process
+        return self.__class__, (self.message, self.phonetics, self.language, self.category, self.position)
+
+
+class NoMatchError(TransliterationError):
+    """
+    No match rule matches phonetics[position:]
+    """
+
+
+class MissingCoordError(TransliterationError):
+    """
+    Match rules give coords which are not in the transliteration section
+    """
+
+
+class NoPhoneticsError(TransliterationError):
+    """
+    espeak did not answer the word, so it has no phonetics
+    """
+
 
 def get_rule_file_path(language):
     return os.path.join(RULES_DIR, language + '.rule')
 
 
+def get_dict_file_path(language):
+    return os.path.join(RULES_DIR, language + '.dict')
+
+
 def get_rule_script_import_path(language):
     return '.rules.{}'.format(language.replace('-', '_'))
 
@@ -80,6 +189,69 @@ def get_rule_script_file_path(language):
     return os.path.join(RULES_DIR, language.replace('-', '_') + '.py')
 
 
+def get_rule_cache_path(language):
+    return os.path.join(RULE_CACHE_DIR, language + '.pickle')
+
+
+def get_source_mtimes(language):
+    """
+    Modification times of the .rule file, the python script and the .dict file of a language, None if missing.
+    A loaded language is out of date if they change.
+    """
+    mtimes = []
+    for path in (get_rule_file_path(language), get_rule_script_file_path(language), get_dict_file_path(language)):
+        try:
+            mtimes.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            mtimes.append(None)
+    return tuple(mtimes)
+
+
+def get_rule_digest(file_path):
+    """
+    Digest of a .rule file and its python script if exists. The compiled rule is out of date if it changes.
+    """
+    language = os.path.split(os.path.splitext(file_path)[0])[1]
+    sha1 = hashlib.sha1()
+    for path in (file_path, get_rule_script_file_path(language)):
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                sha1.update(f.read())
+    return sha1.hexdigest()
+
+
+def load_rule(file_path):
+    """
+    Load a Rule from the compiled rule cache. The .rule file is parsed only when it has changed since last time,
+    then the cache is updated.
+    :param file_path: path of the .rule file
+    :return: Rule
+    """
+    language = os.path.split(os.path.splitext(file_path)[0])[1]
+    cache_path = get_rule_cache_path(language)
+    digest = get_rule_digest(file_path)
+    try:
+        with open(cache_path, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['version'] == RULE_CACHE_VERSION and cached['digest'] == digest:
+            print('[OK] Rule file "{}" (cached).'.format(file_path))
+            return cached['rule']
+    except Exception:
+        pass  # No cache, or an unreadable one. Parse the rule file.
+    with open(file_path, 'r', encoding='utf8') as rule_file:
+        rule = Rule(rule_file)
+    try:
+        os.makedirs(RULE_CACHE_DIR, exist_ok=True)
+        tmp_path = cache_path + '.{}.tmp'.format(os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'version': RULE_CACHE_VERSION, 'digest': digest, 'rule': rule}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass  # The cache is optional
+    return rule
+
+
 def log(msg, line_number, file_path, section=None):
     assert isinstance(line_number, int)
     assert isinstance(file_path, str)
@@ -90,17 +262,96 @@ def log(msg, line_number, file_path, section=None):
         return msg + ' at line {} in file : {}'.format(line_number, file_path)
 
 
-def espeak(word, language_code):
+def register_batch_writer(output_format):
+    """
+    Register a function creating a batch writer, so that it can be used by name in "ppat batch -f".
+    The function is called with the output file, writes the header if any, and returns a function writing one row.
+    """
+    def decorator(func):
+        BATCH_WRITERS[output_format] = func
+        return func
+    return decorator
+
+
+def get_batch_writer(output_file, output_format):
+    """
+    Get a function writing one batch result row to output_file in the given format.
+    The header is written at once for tsv, csv and yml.
+    :param output_file: a text file object
+    :param output_format: one of BATCH_FORMATS
+    :return: function(row), row is a list or TransliterationResult in the order of BATCH_FIELDS
+    """
+    assert output_format in BATCH_FORMATS
+
+    return BATCH_WRITERS[output_format](output_file)
+
+
+@register_batch_writer('tsv')
+def _tsv_writer(output_file):
+    writer = csv.writer(output_file, delimiter='\t', lineterminator='\n')
+    writer.writerow(BATCH_FIELDS)
+    return writer.writerow
+
+
+@register_batch_writer('jsonl')
+def _jsonl_writer(output_file):
+    def write(row):
+        output_file.write(json.dumps(dict(zip(BATCH_FIELDS, row)), ensure_ascii=False) + '\n')
+    return write
+
+
+@register_batch_writer('csv')
+def _csv_writer(output_file):
+    writer = csv.writer(output_file, delimiter=',', lineterminator='\n')
+    writer.writerow(BATCH_FIELDS)
+    return writer.writerow
+
+
+@register_batch_writer('yml')
+def _paradox_localisation_writer(output_file):
+    """
+    Localisation file of Paradox games, keyed by <word>_people and <word>_places. The language of a row is commented.
+    Values, and keys with other chars than letters, digits, "_", "." and "-", are written as YAML double-quoted
+    scalars, which are escaped like JSON strings.
+    """
+    output_file.write(PARADOX_LOCALISATION_LANGUAGE + ':\n')
+
+    def write(row):
+        word, language, phonetics_people, hans_people, phonetics_places, hans_places = row
+        for category, hans in (('people', hans_people), ('places', hans_places)):
+            key = '{}_{}'.format(word, category)
+            if not _PLAIN_YML_KEY.match(key):
+                key = json.dumps(key, ensure_ascii=False)
+            output_file.write(' {}:0 {} # {}\n'.format(key, json.dumps(hans, ensure_ascii=False), language))
+    return write
+
+
+def read_batch_words(input_file):
     """
-    Call EspeakProcessManager.to_ipa_for_language(), replace stresses.
-    :param word:
-    :param language_code:
-    :return:
+    Yield words from input_file, one word per line. Empty lines and lines starting with "#" are skipped.
+    Only the first tab separated field is read, so that a failures report can be used as input to retry.
+    :param input_file: a text file object
+    :return: generator of (line_number, word)
     """
-    assert language_code in get_supported_languages()
+    line_number = 0
+    for line in input_file:
+        line_number += 1
+        word = line.split('\t', 1)[0].strip()
+        if word == '' or word.startswith('#'):
+            continue
+        yield line_number, word
 
-    return espeak_engine.to_ipa_for_language(word, language_code).decode('utf8')\
-        .translate(str.maketrans({'ˈ': None, 'ˌ': None}))
+
+def write_failures(failures, output_file):
+    """
+    Write a failures report in TSV. The header starts with "#", so the report can be read by read_batch_words().
+    :param failures: list<Failure>
+    :param output_file: a text file object
+    """
+    output_file.write('# ' + '\t'.join(FAILURE_FIELDS) + '\n')
+    writer = csv.writer(output_file, delimiter='\t', lineterminator='\n')
+    for failure in failures:
+        writer.writerow(failure)
 
 
 @total_ordering
@@ -109,8 +360,9 @@ class MatchRule(object):
     <pre>)<match>(<pro> => coord
 
     <match> will be separated into str by "|" when loaded by Rule.
-    <pre> WILL NOT be added a "$" at the tail when loaded by Rule.
-    <post> WILL NOT be added a "^" at the beginning when loaded by Rule.
+    <pre> always ends where <match> begins, as if a "$" was added at its tail. It is searched in a window of its max
+    width before <match> if it has one.
+    <post> WILL NOT be added a "^" at the beginning when loaded by Rule. A leading "^" applies to the whole <post>.
 
     """
 
@@ -126,33 +378,143 @@ class MatchRule(object):
 
         return min(match_rule_list)
 
+    __slots__ = ('line_number', 'match', 'prefix', 'postfix', 'coord', 'prefix_pattern', 'prefix_width',
+                 'postfix_pattern', 'postfix_method')
+
+    # dict{pattern: compiled pattern}, rules with the same <pre> or <post> share one compiled pattern
+    _compiled_patterns = {}
+
+    @classmethod
+    def compile_pattern(cls, pattern):
+        compiled = cls._compiled_patterns.get(pattern)
+        if compiled is None:
+            compiled = cls._compiled_patterns.setdefault(pattern, re.compile(pattern))
+        return compiled
+
+    @classmethod
+    def compile_prefix(cls, prefix):
+        """
+        Compile <pre> to be searched in phonetics[0:start] by pattern.search(phonetics, 0, start) without slicing.
+        It is anchored by "\\Z", so that it only matches right before <match>.
+        :param prefix: str or None
+        :return: compiled pattern or None
+        """
+        if prefix is None:
+            return None
+        return cls.compile_pattern('(?:' + prefix + ')\\Z')
+
+    @staticmethod
+    def get_width(pattern):
+        """
+        Max number of chars a <pre> or <post> can match. <pre> is searched in phonetics[start - width:start] only.
+        "^", "\\b" and lookbehinds still see the whole phonetics, as the window is given by pos instead of slicing.
+        :param pattern: str or None
+        :return: int or None if unbounded, e.g. "a+"
+        """
+        if pattern is None:
+            return None
+        width = sre_parse.parse(pattern).getwidth()[1]
+        return None if width >= sre_constants.MAXREPEAT else width
+
+    @classmethod
+    def compile_postfix(cls, postfix):
+        """
+        Compile <post> to be checked against phonetics[end:] without slicing.
+        A <post> starts with "^" is only matched at the end of <match> by pattern.match(phonetics, end),
+        instead of scanning the rest of the word. Its body is grouped, so that "^a|b" is anchored in both branches.
+        :param postfix: str or None
+        :return: tuple(compiled pattern or None, method name of the pattern to call)
+        """
+        if postfix is None:
+            return None, None
+        if postfix.startswith('^') and '^' not in postfix[1:]:
+            return cls.compile_pattern('(?:' + postfix[1:] + ')'), 'match'
+        if '^' not in postfix and '(?<' not in postfix:
+            return cls.compile_pattern(postfix), 'search'
+        return cls.compile_pattern(postfix), None  # "^" in the middle or a lookbehind, needs a real slice
+
     def __init__(self, line_number, prefix, match, postfix, coord):
         assert isinstance(line_number, int) and line_number > 0
         assert isinstance(match, str)
         assert isinstance(coord, int) and coord > 0
 
+        # Matches and contexts repeat a lot across the sections and languages, keep one copy of each
         self.line_number = line_number
-        self.match = match
-        self.prefix = prefix
-        self.postfix = postfix
+        self.match = sys.intern(match)
+        self.prefix = None if prefix is None else sys.intern(prefix)
+        self.postfix = None if postfix is None else sys.intern(postfix)
         self.coord = coord
+        self.prefix_pattern = self.compile_prefix(prefix)
+        self.prefix_width = self.get_width(prefix)
+        self.postfix_pattern, self.postfix_method = self.compile_postfix(postfix)
 
-    def check(self, prefix, postfix):
+    def check(self, phonetics, start, end):
         """
-        Check candidate's prefix and postfix if prefix or postfix is not None
-        :param prefix: the actual prefix
-        :param postfix: the actual postfix
+        Check candidate's prefix phonetics[0:start] and postfix phonetics[end:] if prefix or postfix is not None
+        :param phonetics: the whole phonetics
+        :param start: index where <match> begins
+        :param end: index where <match> ends
         :return:
         """
-        prefix_pass = True
-        postfix_pass = True
+        if self.prefix_pattern is not None:
+            pos = 0 if self.prefix_width is None else max(0, start - self.prefix_width)
+            if not self.prefix_pattern.search(phonetics, pos, start):
+                return False
+        if self.postfix_pattern is not None:
+            if self.postfix_method == 'match':
+                return self.postfix_pattern.match(phonetics, end) is not None
+            elif self.postfix_method == 'search':
+                return self.postfix_pattern.search(phonetics, end) is not None
+            return self.postfix_pattern.search(phonetics[end:]) is not None
+        return True
+
+    def get_context_widths(self):
+        """
+        Number of phonetics before <match> which <pre>, and after <match> which <post> may look at, plus one to tell
+        whether the phonetics begin or end there
+        :return: tuple(int, int): 0 for an absent context, None for one which may look at any phonetics
+        """
+        prefix_width = 0
         if self.prefix is not None:
-            if not re.search(self.prefix, prefix):
-                prefix_pass = False
+            prefix_width = None
+            if self.prefix_width is not None and not _LOOKAROUND.search(self.prefix):
+                prefix_width = self.prefix_width + 1
+        postfix_width = 0
         if self.postfix is not None:
-            if not re.search(self.postfix, postfix):
-                postfix_pass = False
-        return prefix_pass and postfix_pass
+            postfix_width = None
+            if self.postfix_method == 'match' and not _LOOKAROUND.search(self.postfix):
+                width = self.get_width(self.postfix[1:])
+                postfix_width = None if width is None else width + 1
+        return prefix_width, postfix_width
+
+    def shadows(self, other):
+        """
+        Whether other can never be chosen because of self: both have the same <match>, self has a higher priority and
+        passes the check whenever other passes, as each context of self is either absent or the same as other's
+        """
+        return self.match == other.match and self.line_number < other.line_number \
+            and (self.prefix is None or self.prefix == other.prefix) \
+            and (self.postfix is None or self.postfix == other.postfix)
+
+    @staticmethod
+    def prune_shadowed(match_rule_list):
+        """
+        :param match_rule_list: MatchRules of the same <match>
+        :return: tuple: (tuple<MatchRule> which can be chosen, list<tuple(shadowed MatchRule, MatchRule shadowing it)>)
+        """
+        kept = []
+        shadowed = []
+        for rule in sorted(match_rule_list):
+            shadowing = [i for i in kept if i.shadows(rule)]
+            if shadowing:
+                shadowed.append((rule, shadowing[0]))
+            else:
+                kept.append(rule)
+        return tuple(kept), shadowed
+
+    def __reduce__(self):
+        # Built again when unpickled, so that strings are interned and patterns are shared across the loaded rules
+        return MatchRule, (self.line_number, self.prefix, self.match, self.postfix, self.coord)
 
     def __eq__(self, other):
         return self.line_number == other.line_number
@@ -161,19 +523,158 @@ class MatchRule(object):
         return self.line_number < other.line_number
 
 
+class MatchTrie(object):
+    """
+    A trie over the matches of one match section, e.g. ".vowels people".
+
+    Walking it from a position of the phonetics finds the matches of all the lengths at that position in a single pass,
+    instead of slicing and looking up every length from Rule.max_match_length down to 1.
+    """
+
+    def __init__(self, match_rules):
+        """
+        :param match_rules: dict{MatchRule.match: list<MatchRule>}
+        """
+        self._match_rules = match_rules
+        self._root = {}
+        self.max_length = max([len(match) for match in match_rules.keys()] or [0])
+        # The result of matching at a position only depends on the next max_length phonetics, and on the phonetics
+        # which <pre> and <post> look at, see MatchRule.get_context_widths()
+        widths = [rule.get_context_widths() for rules in match_rules.values() for rule in rules]
+        self.prefix_width, self.postfix_width = [None if None in i else max(i or [0]) for i in zip(*widths)] or [0, 0]
+        for match, rules in match_rules.items():
+            node = self._root
+            for char in match:
+                node = node.setdefault(sys.intern(char), {})
+            node[None] = rules  # None marks the end of a match, as no phonetic is None
+
+    def __reduce__(self):
+        # Built again when unpickled, a trie is cheap to build but its nodes would not share their keys otherwise
+        return MatchTrie, (self._match_rules,)
+
+    def prefixes(self, phonetics, start):
+        """
+        Find all the matches which phonetics[start:] starts with
+        :param phonetics:
+        :param start:
+        :return: list<tuple(match_length, list<MatchRule>)>, from the shortest to the longest
+        """
+        result = []
+        node = self._root
+        for i in range(start, len(phonetics)):
+            node = node.get(phonetics[i])
+            if node is None:
+                break
+            if None in node:
+                result.append((i + 1 - start, node[None]))
+        return result
+
+
+class TransliterationGrid(object):
+    """
+    A transliteration section, e.g. ".transliteration people", compiled into a dense 2-D table indexed by coords.
+    Looking up a han is two index operations, no key is built.
+    """
+
+    def __init__(self, hans):
+        """
+        :param hans: dict{tuple(coord_c, coord_v): han}
+        """
+        rows_number = max([c for c, v in hans.keys()] or [0]) + 1
+        columns_number = max([v for c, v in hans.keys()] or [0]) + 1
+        rows = [[None] * columns_number for _ in range(rows_number)]
+        for (coord_c, coord_v), han in hans.items():
+            rows[coord_c][coord_v] = sys.intern(han)  # The same hans repeat in people and places, and across languages
+        self.rows = tuple(tuple(row) for row in rows)
+
+    def __reduce__(self):
+        return TransliterationGrid, ({(coord_c, coord_v): han for coord_c, row in enumerate(self.rows)
+                                      for coord_v, han in enumerate(row) if han is not None},)
+
+    def get(self, coord_c, coord_v):
+        """
+        :return: str: han, or None if the coords are not in the table
+        """
+        try:
+            return self.rows[coord_c][coord_v]
+        except IndexError:
+            return None
+
+    def missing_coords(self, consonant_coords, vowel_coords):
+        """
+        Coords that can be given by the match sections but have no han in the table
+        :param consonant_coords: iterable<int>: coords in the consonants section
+        :param vowel_coords: iterable<int>: coords in the vowels section
+        :return: list<tuple(coord_c, coord_v)>, sorted
+        """
+        consonant_coords = set(consonant_coords) | {1}
+        vowel_coords = set(vowel_coords) | {1}
+        return sorted((c, v) for c in consonant_coords for v in vowel_coords
+                      if (c, v) != (1, 1) and self.get(c, v) is None)
+
+    def unused_coords(self, consonant_coords, vowel_coords):
+        """
+        Coords that have a han in the table but can never be given by the match sections
+        :param consonant_coords: iterable<int>: coords in the consonants section
+        :param vowel_coords: iterable<int>: coords in the vowels section
+        :return: list<tuple(coord_c, coord_v)>, sorted
+        """
+        consonant_coords = set(consonant_coords) | {1}
+        vowel_coords = set(vowel_coords) | {1}
+        return [(c, v) for c, row in enumerate(self.rows) for v, han in enumerate(row)
+                if han is not None and (c not in consonant_coords or v not in vowel_coords)]
+
+    def __eq__(self, other):
+        return isinstance(other, TransliterationGrid) and self.rows == other.rows
+
+
+class Substitutions(object):
+    """
+    A substitutions section, e.g. ".substitutions places", compiled into one pattern and applied in one pass, before the
+    function of the ".post_process" section if any.
+
+    "^东 = 栋" substitutes at the beginning of the hans, "海$ = 亥" at the end, "代 = 德" anywhere.
+    At a position, a substitution at the beginning goes first, then one at the end, then the longest one anywhere.
+    """
+
+    def __init__(self, substitutions):
+        """
+        :param substitutions: list<tuple(key in the section, replacement)>
+        """
+        def order(item):
+            key = item[0]
+            return not key.startswith('^'), not key.endswith('$'), -len(key)
+
+        self.substitutions = sorted(substitutions, key=order)
+        alternatives = []
+        for key, replacement in self.substitutions:
+            initial, final = key.startswith('^'), key.endswith('$')
+            target = key[1 if initial else 0: -1 if final else len(key)]
+            assert target, 'Nothing to substitute in "{}"'.format(key)
+            alternatives.append('({}{}{})'.format(r'\A' if initial else '', re.escape(target), r'\Z' if final else ''))
+        # Group i + 1 is the substitution i, as the escaped targets have no groups
+        self.pattern = re.compile('|'.join(alternatives)) if alternatives else None
+        self.replacements = [replacement for key, replacement in self.substitutions]
+
+    def apply(self, hans):
+        if self.pattern is None:
+            return hans
+        replacements = self.replacements
+        return self.pattern.sub(lambda match: replacements[match.lastindex - 1], hans)
+
+    def __eq__(self, other):
+        return isinstance(other, Substitutions) and self.substitutions == other.substitutions
+
+
 class Rule(object):
     """
     Python Object of one .rule file
+
+    Tables of a Rule are per instance and must not be modified after loaded, so that one Rule can be shared by threads.
     """
-    vowels = []
-    consonants = []
-    vowels_people = {}
-    vowels_places = {}
-    consonants_people = {}
-    consonants_places = {}
+    vowels = ()
+    consonants = ()
     max_match_length = -1  # Max match's length over the matches
-    transliteration_people = {}
-    transliteration_places = {}
     to_phonetics_people = None
     to_phonetics_places = None
     post_process_people = None
@@ -182,7 +683,8 @@ class Rule(object):
     method_sections = ('.to_phonetics', '.post_process',)
     match_sections = ('.vowels people', '.vowels places', '.consonants people', '.consonants places',)
     transliteration_sections = ('.transliteration people', '.transliteration places',)
-    all_sections = info_sections + method_sections + match_sections + transliteration_sections
+    substitution_sections = ('.substitutions people', '.substitutions places',)  # optional
+    all_sections = info_sections + method_sections + match_sections + transliteration_sections + substitution_sections
 
     def _get_section_attr(self, section_name):
         assert section_name in self.match_sections + self.transliteration_sections
@@ -227,12 +729,6 @@ class Rule(object):
 
         return int(items[0].strip()), int(items[1].strip())
 
-    @staticmethod
-    def coord_to_key(coord_c, coord_v):
-        assert isinstance(coord_c, int) and isinstance(coord_v, int)
-
-        return str(coord_c) + ',' + str(coord_v)
-
     def parse_pre_or_post(self, pre_or_post):
         if pre_or_post is None:
             return None
@@ -240,9 +736,151 @@ class Rule(object):
         any_vowels = '[' + '|'.join(self.vowels) + ']'
         return pre_or_post.replace('&', any_consonants).replace('@', any_vowels)
 
+    @property
+    def shares_phonetics(self):
+        """
+        :return: bool: whether people and places use the same method in .to_phonetics section, so that phonetics of a word
+        are got once for both
+        """
+        methods = self.to_phonetics_methods
+        return 'people' in methods and methods.get('people') == methods.get('places')
+
+    def to_phonetics_both(self, word):
+        """
+        :param word:
+        :return: tuple: (phonetics_people, phonetics_places)
+        """
+        phonetics_people = self.to_phonetics_people(word)
+        if self.shares_phonetics:
+            return phonetics_people, phonetics_people
+        return phonetics_people, self.to_phonetics_places(word)
+
+    def to_phonetics_batch(self, words, category):
+        """
+        Get phonetics of many words at a time. Words are sent to espeak in one go if category uses espeak.
+        :param words: list<str>
+        :param category: people or places
+        :return: list<str>
+        """
+        assert category in ('people', 'places',)
+
+        backend = self.to_phonetics_backends.get(category)
+        if backend is not None:
+            return backend.to_phonetics_batch(words)
+        to_phonetics = getattr(self, 'to_phonetics_' + category)
+        return [to_phonetics(word) for word in words]
+
+    async def to_phonetics_async(self, word, category, espeak_pool):
+        """
+        Get phonetics of a word, by an AsyncEspeakPool if category uses espeak.
+        :param word:
+        :param category: people or places
+        :param espeak_pool: AsyncEspeakPool
+        :return: str
+        """
+        assert category in ('people', 'places',)
+
+        backend = self.to_phonetics_backends.get(category)
+        if backend is not None:
+            return await backend.to_phonetics_async(word, espeak_pool)
+        return getattr(self, 'to_phonetics_' + category)(word)
+
+    def set_to_phonetics(self, k, v, line_number=0):
+        """
+        Set self.to_phonetics_<k> by its method name v in .to_phonetics section, which is a backend in backends.py
+        or a function in the python script of the rule file
+        """
+        self.to_phonetics_methods[k] = v
+        backend = get_backend(v, self.language_code)
+        if backend is not None:
+            self.to_phonetics_backends[k] = backend
+            setattr(self, 'to_phonetics_' + k, backend.to_phonetics)
+        else:
+            self.to_phonetics_backends.pop(k, None)
+            assert os.path.exists(get_rule_script_file_path(self.language_code)), \
+                log('No such file {}.py'.format(self.language_code),
+                    line_number, self.rule_file_name, '.to_phonetics')
+            setattr(self, 'to_phonetics_' + k,
+                    importlib.import_module(
+                        get_rule_script_import_path(self.language_code),
+                        package='ppat').__getattribute__(v),
+                    )
+
+    def set_post_process(self, k, v, line_number=0):
+        """
+        Set self.post_process_<k> by its method name v in .post_process section
+        """
+        if v == 'copy':
+            setattr(self, 'post_process_' + k, lambda x: x)
+        else:
+            assert os.path.exists(get_rule_script_file_path(self.language_code)), \
+                log('No such file {}.py in {}'.format(get_rule_script_file_path(self.language_code),
+                                                      self.language_code),
+                    line_number, self.rule_file_name, '.post_process')
+            setattr(self, 'post_process_' + k,
+                    importlib.import_module(
+                        get_rule_script_import_path(self.language_code),
+                        package='ppat').__getattribute__(v)
+                    )
+
+    def post_process(self, hans, category):
+        """
+        Apply the substitutions section of category, then the function in .post_process section if it is not copy
+        :param hans:
+        :param category: people or places
+        :return: str
+        """
+        hans = self.substitutions[category].apply(hans)
+        if self.post_process_methods.get(category, 'copy') == 'copy':
+            return hans
+        return getattr(self, 'post_process_' + category)(hans)
+
+    def lint(self):
+        """
+        Report match rules which can never be chosen, and coords of the transliteration sections which can never be
+        matched or have no han.
+        :return: list<str>: messages, one per finding
+        """
+        messages = []
+        for section in self.match_sections:
+            for rule, by in self.shadowed_rules[section[1:].replace(' ', '_')]:
+                messages.append('{}:{}: "{}" in {} is shadowed by line {}, it can never be chosen.'.format(
+                    self.rule_file_name, rule.line_number, rule.match, section, by.line_number))
+        for section in self.transliteration_sections:
+            category = section.split()[1]
+            for coord_c, coord_v in self.unused_coords[category]:
+                messages.append('{}: {}, {} in {} is never matched.'.format(
+                    self.rule_file_name, coord_c, coord_v, section))
+            for coord_c, coord_v in self.missing_coords[category]:
+                messages.append('{}: {}, {} in {} has no transliteration, but it can be matched.'.format(
+                    self.rule_file_name, coord_c, coord_v, section))
+        return messages
+
+    def __getstate__(self):
+        # Methods are set again by their names when unpickled, as lambdas cannot be pickled
+        state = self.__dict__.copy()
+        state['to_phonetics_backends'] = {}
+        for k in ('people', 'places'):
+            state.pop('to_phonetics_' + k, None)
+            state.pop('post_process_' + k, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for k, v in self.to_phonetics_methods.items():
+            self.set_to_phonetics(k, v)
+        for k, v in self.post_process_methods.items():
+            self.set_post_process(k, v)
+
     def __init__(self, rule_file):
         assert isinstance(rule_file, _io.TextIOWrapper)
 
+        self.to_phonetics_methods = {}  # dict{people|places: method name in .to_phonetics section}
+        self.to_phonetics_backends = {}  # dict{people|places: PhoneticsBackend}, if the method is a backend
+        self.post_process_methods = {}  # dict{people|places: method name in .post_process section}
+        substitutions = {'people': [], 'places': []}  # dict{people|places: list<tuple(key, replacement)>}
+        for section in self.match_sections + self.transliteration_sections:
+            setattr(self, section[1:].replace(' ', '_'), {})  # not shared with the other languages
         self.rule_file_name = rule_file.name
         self.language_code = os.path.split(os.path.splitext(rule_file.name)[0])[1]
         current_section = ''
@@ -254,6 +892,7 @@ class Rule(object):
             if line.startswith('//') or line == '':
                 continue
             if line.startswith('.'):
+                assert line in met_sections, log('Unknown section "{}"'.format(line), line_number, rule_file.name)
                 assert not met_sections[line], log('Section "{}" duplicated'.format(line),
                                                    line_number, rule_file.name)
                 met_sections[line] = True
@@ -266,26 +905,10 @@ class Rule(object):
                 k, v = self.split_kv(line)
                 assert k in ('vowels', 'consonants',), log('Key "{}" not allowed',
                                                            line_number, rule_file.name, current_section)
-                setattr(self, k, [i.strip() for i in v.split('|')])
+                setattr(self, k, tuple(i.strip() for i in v.split('|')))
             elif current_section == '.to_phonetics':
                 k, v = self.split_kv(line)
-                if v == 'copy':
-                    setattr(self, 'to_phonetics_' + k, lambda x: x)
-                elif v == 'lowercase':
-                    setattr(self, 'to_phonetics_' + k, lambda x: x.lower())
-                elif v == 'espeak':
-                    assert self.language_code in get_supported_languages(), \
-                        'Cannot use espeak for language "{}"'.format(self.language_code)
-                    setattr(self, 'to_phonetics_' + k, lambda x: espeak(x, self.language_code))
-                else:
-                    assert os.path.exists(get_rule_script_import_path(self.language_code)), \
-                        log('No such file {}.py'.format(self.language_code),
-                            line_number, rule_file.name, current_section)
-                    setattr(self, 'to_phonetics_' + k,
-                            importlib.import_module(
-                                get_rule_script_import_path(self.language_code),
-                                package='ppat').__getattribute__(v),
-                            )
+                self.set_to_phonetics(k, v, line_number)
             elif current_section in self.match_sections:
                 k, v = self.split_kv(line)
                 pre, match_list, post = self.parse_k_in_match_section(k)
@@ -303,36 +926,61 @@ class Rule(object):
             elif current_section in self.transliteration_sections:
                 k, v = self.split_kv(line)
                 coord_c, coord_v = self.parse_k_in_transliteration_section(k)
-                self._get_section_attr(current_section)[self.coord_to_key(coord_c, coord_v)] = v
+                self._get_section_attr(current_section)[(coord_c, coord_v)] = v
+            elif current_section in self.substitution_sections:
+                k, v = self.split_kv(line)
+                assert k.strip('^$'), log('Nothing to substitute', line_number, rule_file.name, current_section)
+                substitutions[current_section.split()[1]].append((k, v))
             elif current_section == '.post_process':
                 k, v = self.split_kv(line)
                 assert k in ('people', 'places')
-
-                if v == 'copy':
-                    setattr(self, 'post_process_' + k, lambda x: x)
-                else:
-                    assert os.path.exists(get_rule_script_file_path(self.language_code)), \
-                        log('No such file {}.py in {}'.format(get_rule_script_file_path(self.language_code),
-                                                              self.language_code),
-                            line_number, rule_file.name, current_section)
-                    setattr(self, 'post_process_' + k,
-                            importlib.import_module(
-                                get_rule_script_import_path(self.language_code),
-                                package='ppat').__getattribute__(v)
-                            )
+                self.post_process_methods[k] = v
+                self.set_post_process(k, v, line_number)
             else:
                 log('Invalid section "{}"'.format(line), line_number, rule_file.name)
-        assert all(met_sections.values()), 'Missing necessary section(s).\n' + str(met_sections)
+        assert all(v for k, v in met_sections.items() if k not in self.substitution_sections), \
+            'Missing necessary section(s).\n' + str(met_sections)
+        self.substitutions = {k: Substitutions(v) for k, v in substitutions.items()}  # dict{people|places: ...}
         assert self.max_match_length > 1
+        # MatchRules which can never be chosen are dropped, so that they are not checked by to_hans()
+        self.shadowed_rules = {}  # dict{vowels_people: list<tuple(shadowed MatchRule, MatchRule shadowing it)>, ...}
+        for section in self.match_sections:
+            match_rules = self._get_section_attr(section)
+            shadowed_rules = self.shadowed_rules.setdefault(section[1:].replace(' ', '_'), [])
+            for match in match_rules.keys():
+                match_rules[match], shadowed = MatchRule.prune_shadowed(match_rules[match])
+                shadowed_rules.extend(shadowed)
+            shadowed_rules.sort(key=lambda i: i[0])
+        self.match_tries = {section[1:].replace(' ', '_'): MatchTrie(self._get_section_attr(section))
+                            for section in self.match_sections}  # dict{vowels_people: MatchTrie, ...}
+        self.missing_coords = {}  # dict{people|places: list<tuple(coord_c, coord_v)>}
+        self.unused_coords = {}  # dict{people|places: list<tuple(coord_c, coord_v)>}
+        for section in self.transliteration_sections:
+            category = section.split()[1]
+            grid = TransliterationGrid(self._get_section_attr(section))
+            setattr(self, section[1:].replace(' ', '_'), grid)
+            consonant_coords = [rule.coord for rules in getattr(self, 'consonants_' + category).values()
+                                for rule in rules]
+            vowel_coords = [rule.coord for rules in getattr(self, 'vowels_' + category).values() for rule in rules]
+            self.missing_coords[category] = grid.missing_coords(consonant_coords, vowel_coords)
+            self.unused_coords[category] = grid.unused_coords(consonant_coords, vowel_coords)
+            if self.missing_coords[category]:
+                # Not an error, as the shipped rules have gaps. Matching a missing coord fails in to_hans().
+                print('[WARNING] {} coord(s) of {} can be matched but have no transliteration in "{}".'.format(
+                    len(self.missing_coords[category]), category, rule_file.name), file=sys.stderr)
         print('[OK] Rule file "{}".'.format(rule_file.name))
 
 
+# Tables used by RulesManager.to_hans() for one language and one category (people or places)
+MatchContext = namedtuple('MatchContext',
+                          ['rule', 'vowels_match_trie', 'consonants_match_trie', 'transliteration_grid'])
+
+
 class RulesManager(object):
-    rules = {}
-    current_rule = None
-    current_vowels_match_rules = None
-    current_consonants_match_rules = None
-    current_transliteration_dict = None
+    """
+    Loaded rules and the transliterating engine.
+    Matching state is kept in local variables, so one RulesManager can be shared by threads.
+    """
     verbose = False
 
     @staticmethod
@@ -355,59 +1003,203 @@ class RulesManager(object):
         print('='*25)
 
     def __init__(self):
-        for file_path in self.list_rules_path():
-            with open(file_path, 'r', encoding='utf8') as rule_file:
-                rule = Rule(rule_file)
-                self.rules[rule.language_code] = rule
+        # Rule files are loaded on first use of their languages
+        self.rules = {}  # dict{language_code: Rule}, loaded rules
+        self._rules_lock = threading.Lock()
+        self.rule_paths = {os.path.split(os.path.splitext(file_path)[0])[1]: file_path
+                           for file_path in self.list_rules_path()}
+        self.lexicons = {}  # dict{language_code: Lexicon or None}, override dictionaries looked up
+        self.source_mtimes = {}  # dict{language_code: get_source_mtimes()}, when the language was loaded
+        self.hans_cache = LRUCache(HANS_CACHE_SIZE)  # (language, category, phonetics) => hans
+        # (language, category, window, index of the segment in window) => (han, length, coord_c, coord_v)
+        self.segment_cache = LRUCache(SEGMENT_CACHE_SIZE)
+
+    def get_rule(self, language):
+        """
+        Get the Rule of a language, load it if not loaded yet
+        :param language:
+        :return: Rule
+        """
+        assert language in self.get_supported_languages()
+
+        rule = self.rules.get(language)
+        if rule is None:
+            with self._rules_lock:
+                rule = self.rules.get(language)
+                if rule is None:
+                    self.source_mtimes[language] = get_source_mtimes(language)
+                    rule = load_rule(self.rule_paths[language])
+                    self.rules[language] = rule
+        return rule
+
+    def changed_languages(self):
+        """
+        :return: list<str>: loaded languages whose .rule, python script or .dict file has changed since loaded
+        """
+        return [language for language in list(self.rules.keys())
+                if get_source_mtimes(language) != self.source_mtimes.get(language)]
+
+    def reload(self, language=None):
+        """
+        Parse the rule file of a language again and swap it in, with its python script and override dictionary.
+        Other languages, espeak processes and the memo caches of other languages are kept.
+        If the rule file cannot be parsed, the loaded rule is kept and the error is raised.
+        :param language: reload the changed languages of changed_languages() if None
+        :return: list<str>: reloaded languages
+        """
+        if language is None:
+            languages = self.changed_languages()
+        else:
+            self.rule_paths = {os.path.split(os.path.splitext(file_path)[0])[1]: file_path
+                               for file_path in self.list_rules_path()}  # A rule file may be added
+            assert language in self.get_supported_languages(), 'Invalid language code "{}".'.format(language)
+            languages = [language]
+        for language in languages:
+            mtimes = get_source_mtimes(language)
+            script_module = sys.modules.get('ppat' + get_rule_script_import_path(language))
+            if script_module is not None and os.path.exists(get_rule_script_file_path(language)):
+                importlib.reload(script_module)
+            rule = load_rule(self.rule_paths[language])
+            lexicon = load_lexicon(get_dict_file_path(language), language)
+            with self._rules_lock:
+                self.rules[language] = rule
+                self.lexicons[language] = lexicon
+                self.source_mtimes[language] = mtimes
+            self.hans_cache.remove_if(lambda key: key[0] == language)
+            self.segment_cache.remove_if(lambda key: key[0] == language)
+        return languages
+
+    def get_lexicon(self, language):
+        """
+        Get the override dictionary of a language, load it if not loaded yet
+        :param language:
+        :return: Lexicon, or None if the language has no .dict file
+        """
+        if language not in self.lexicons:
+            with self._rules_lock:
+                if language not in self.lexicons:
+                    self.lexicons[language] = load_lexicon(get_dict_file_path(language), language)
+        return self.lexicons[language]
+
+    def lookup(self, word, language):
+        """
+        Look a word up in the override dictionary of a language
+        :param word:
+        :param language:
+        :return: tuple: (phonetics_people, hans_people, phonetics_places, hans_places), or None if not found
+        """
+        lexicon = self.get_lexicon(language)
+        if lexicon is None:
+            return None
+        hans = lexicon.get(word)
+        if hans is None:
+            return None
+        if profiler.enabled:
+            profiler.count((language, 'lexicon hits'))
+        return LEXICON_PHONETICS, hans[0], LEXICON_PHONETICS, hans[1]
+
+    def get_match_context(self, language, category):
+        assert category in ('people', 'places',)
+
+        rule = self.get_rule(language)
+        return MatchContext(rule,
+                            rule.match_tries['vowels_' + category],
+                            rule.match_tries['consonants_' + category],
+                            getattr(rule, 'transliteration_' + category))
 
     def get_supported_languages(self):
-        return self.rules.keys()
+        return self.rule_paths.keys()
 
     def get_supported_language_full_name(self, language_code):
-        return self.rules[language_code].language_full_name
+        return self.get_rule(language_code).language_full_name
 
     def get_supported_languages_and_full_names(self):
-        return {k: self.rules[k].language_full_name for k in self.rules.keys()}
+        return {k: self.get_supported_language_full_name(k) for k in sorted(self.get_supported_languages())}
 
-    def _longest_prefix_match(self, category, phonetics, start):
+    @staticmethod
+    def _longest_prefix_match(context, category, phonetics, start):
         assert category in ('vowels', 'consonants',)
         assert isinstance(phonetics, str)
         assert isinstance(start, int)
 
-        # a match rule that both <people|places> and <vowels|conspnants> are specified
-        match_rules = getattr(self, 'current_' + category + '_match_rules')  # dict{MatchRule.match: MatchRule())
-
-        # Match from the possible longest length. If not matched, try a shorter one.
-        expected_match_length = min(self.current_rule.max_match_length, len(phonetics[start:]))
-        if expected_match_length <= 0:
-            return -1, ''  # Nothing to match
-        candidates = []  # MatchRules that have been checked pre/postfix
-        while expected_match_length > 0:
-            prefix = phonetics[0: start]
-            expected_match = phonetics[start: start + expected_match_length]
-            postfix = phonetics[start + expected_match_length:]
-            candidate_matches = match_rules.get(expected_match, [])  # MatchRules that have not been checked pre/postfix
-            for candidate_match in candidate_matches:
-                if candidate_match.check(prefix, postfix):
-                    candidates.append(candidate_match)
+        if profiler.enabled:
+            return RulesManager._profiled_longest_prefix_match(context, category, phonetics, start)
+
+        # a trie of match rules that both <people|places> and <vowels|conspnants> are specified
+        match_trie = getattr(context, category + '_match_trie')
+
+        # Check from the longest match. If no rule passes pre/postfix checking, try a shorter one.
+        for match_length, candidate_matches in reversed(match_trie.prefixes(phonetics, start)):
+            end = start + match_length
+            candidates = [i for i in candidate_matches if i.check(phonetics, start, end)]  # checked pre/postfix
             if candidates:
+                final_match_rule = MatchRule.highest_priority(candidates)
+                return final_match_rule.coord, final_match_rule.match
+        return -1, ''  # Nothing to match
+
+    @staticmethod
+    def _profiled_longest_prefix_match(context, category, phonetics, start):
+        """
+        _longest_prefix_match() recording its time, time of MatchRule.check() and the number of candidates tried
+        """
+        language = context.rule.language_code
+        lpm_start = time.perf_counter()
+        match_trie = getattr(context, category + '_match_trie')
+        result = -1, ''
+        tried = 0
+        check_time = 0.0
+        for match_length, candidate_matches in reversed(match_trie.prefixes(phonetics, start)):
+            end = start + match_length
+            check_start = time.perf_counter()
+            candidates = [i for i in candidate_matches if i.check(phonetics, start, end)]
+            check_time += time.perf_counter() - check_start
+            tried += len(candidate_matches)
+            if candidates:
+                final_match_rule = MatchRule.highest_priority(candidates)
+                result = final_match_rule.coord, final_match_rule.match
                 break
-            else:
-                expected_match_length -= 1
-        if candidates:
-            final_match_rule = MatchRule.highest_priority(candidates)
-            return final_match_rule.coord, final_match_rule.match
-        else:
-            return -1, ''  # Nothing to match
+        profiler.add_time((language, 'rule check'), check_time)
+        profiler.add_time((language, 'longest prefix match'), time.perf_counter() - lpm_start)
+        profiler.count((language, 'candidates'), tried)
+        return result
 
-    def _find_han_by_coords(self, coord_c, coord_v):
+    @staticmethod
+    def _find_han_by_coords(context, coord_c, coord_v):
+        """
+        :return: str: han, or None if the coords are not in the transliteration section
+        """
         assert isinstance(coord_c, int) and isinstance(coord_v, int)
 
-        han = self.current_transliteration_dict.get(Rule.coord_to_key(coord_c, coord_v), '')
-        assert han, 'No such coords ({}, {}) for rule "{}".'.format(coord_c, coord_v, self.current_rule.rule_file_name)
-        return han
+        return context.transliteration_grid.get(coord_c, coord_v)
 
-    def to_hans(self, phonetics, language, category):
+    def _next_han(self, context, phonetics, start):
+        """
+        Match a consonant and a vowel, or either of them, from phonetics[start]
+        :return: tuple(han, length of the phonetics matched, coord_c, coord_v), length is 0 if no rule matched,
+        han is None if the coords are not in the transliteration section
+        """
+        coord_c, coord_v, length = self._next_coords(context, phonetics, start)
+        if not length:
+            return None, 0, coord_c, coord_v
+        return self._find_han_by_coords(context, coord_c, coord_v), length, coord_c, coord_v
+
+    def _next_coords(self, context, phonetics, start):
+        coord_v, match = self._longest_prefix_match(context, 'vowels', phonetics, start)
+        if match:
+            return 1, coord_v, len(match)
+        coord_c, match = self._longest_prefix_match(context, 'consonants', phonetics, start)
+        if not match:
+            return -1, -1, 0
+        end = start + len(match)
+        # the consonant is the last phonetic of the word, no need to check vowels
+        if end == len(phonetics):
+            return coord_c, 1, len(match)
+        coord_v, vowel_match = self._longest_prefix_match(context, 'vowels', phonetics, end)
+        if vowel_match:
+            return coord_c, coord_v, len(match) + len(vowel_match)
+        return coord_c, 1, len(match)
+
+    def to_hans(self, phonetics, language, category, fallback=None):
         """
         phonetics => hans
 
@@ -420,61 +1212,341 @@ class RulesManager(object):
         <post> = 'nɑːtʃi'
         <coord_c> = coord of 'b', given by lpm(consonants)
         <coord_v> = coord of 'ə', given by lpm(vowels)
+
+        Results are memoized by (language, category, phonetics). A segment only depends on the next few phonetics and
+        on the ones <pre> and <post> look at, so segments are memoized by them too, unless a <pre> or <post> of the
+        category may look at any phonetics.
         :param phonetics:
         :param language:
         :param category:
+        :param fallback: str: put in place of the phonetics which cannot be transliterated, instead of raising
         :return:
+        :raise NoMatchError: if no match rule matches a part of the phonetics and fallback is None
+        :raise MissingCoordError: if the coords of a part are not in the transliteration section and fallback is None
         """
         assert all([isinstance(i, str) for i in (phonetics, language, category)])
         assert language in self.get_supported_languages()
         assert category in ('people', 'places',)
 
-        start = 0  # index where <match> begins
-        match = ''  # <match>'s content if match succeeded, else ''
-        hans = ''
-        self.current_rule = self.rules[language]
-        self.current_vowels_match_rules = getattr(self.current_rule, 'vowels_' + category)  # a MatchRule dict
-        self.current_consonants_match_rules = getattr(self.current_rule, 'consonants_' + category)
-        self.current_transliteration_dict = getattr(self.current_rule, 'transliteration_' + category)
-        while start + len(match) < len(phonetics):
-            coord_v, match = self._longest_prefix_match('vowels', phonetics, start)
-            if match:
-                hans += self._find_han_by_coords(1, coord_v)
-                start += len(match)
-            else:
-                coord_c, match = self._longest_prefix_match('consonants', phonetics, start)
-                if match:
-                    start += len(match)
-                    # the consonant is the last phonetic of the word, no need to check vowels
-                    if start == len(phonetics):
-                        hans += self._find_han_by_coords(coord_c, 1)
-                        break
-                    coord_v, match = self._longest_prefix_match('vowels', phonetics, start)
-                    if match:
-                        hans += self._find_han_by_coords(coord_c, coord_v)
-                        start += len(match)
-                    else:
-                        hans += self._find_han_by_coords(coord_c, 1)
+        with profiler.stage('to_hans', language):
+            hans = self.hans_cache.get((language, category, phonetics)) if fallback is None else None
+            if hans is not None:
+                if profiler.enabled:
+                    profiler.count((language, 'hans cache hits'))
+                return hans
+            start = 0  # index where <match> begins
+            hans = ''
+            failed = False
+            context = self.get_match_context(language, category)
+            tries = context.consonants_match_trie, context.vowels_match_trie
+            window = None
+            if not any(trie.prefix_width is None or trie.postfix_width is None for trie in tries):
+                # What <pre> looks at before the segment, a consonant and a vowel at most, and what <post> looks at
+                # after them. A window shorter than this reaches the end of the phonetics.
+                window_before = max(trie.prefix_width for trie in tries)
+                window = sum(trie.max_length for trie in tries) + max(trie.postfix_width for trie in tries)
+            while start < len(phonetics):
+                if window is not None:
+                    window_start = max(0, start - window_before)
+                    key = (language, category, phonetics[window_start:start + window], start - window_start)
+                    segment = self.segment_cache.get(key)
+                    if segment is None:
+                        segment = self._next_han(context, phonetics, start)
+                        if segment[1]:
+                            self.segment_cache.put(key, segment)
+                        if profiler.enabled:
+                            profiler.count((language, 'segments'))
+                    elif profiler.enabled:
+                        profiler.count((language, 'segment cache hits'))
                 else:
-                    print('No {} rule matched for phonetics "{}", check your rules file.'.format(category, phonetics))
-                    if self.verbose:
-                        self.debug(category, hans, coord_c, coord_v, phonetics, start)
-                    exit(-1)
-            match = ''  # clear match for the next loop
-        return hans
-
-    def transliterate(self, word, language):
+                    segment = self._next_han(context, phonetics, start)
+                    if profiler.enabled:
+                        profiler.count((language, 'segments'))
+                han, length, coord_c, coord_v = segment
+                if not length:
+                    if fallback is None:
+                        if self.verbose:
+                            self.debug(category, hans, coord_c, coord_v, phonetics, start)
+                        raise NoMatchError('No {} rule of "{}" matched at {} of phonetics "{}", check your rules file.'
+                                           .format(category, language, start, phonetics),
+                                           phonetics, language, category, start)
+                    han, length, failed = fallback, 1, True
+                elif han is None:
+                    if fallback is None:
+                        raise MissingCoordError('No such coords ({}, {}) in {} of rule "{}" for phonetics "{}".'
+                                                .format(coord_c, coord_v, category, context.rule.rule_file_name,
+                                                        phonetics),
+                                                phonetics, language, category, start)
+                    han, failed = fallback, True
+                hans += han
+                start += length
+            if not failed:
+                self.hans_cache.put((language, category, phonetics), hans)
+            return hans
+
+    def transliterate(self, word, language, failures=None):
+        """
+        Transliterate a word. A word in the override dictionary of the language skips espeak and the rules.
+        :param word:
+        :param language:
+        :param failures: list: see transliterate_batch()
+        :return: tuple: (phonetics_people, hans_people, phonetics_places, hans_places)
+        """
         assert isinstance(word, str) and ' ' not in word
         assert language in self.get_supported_languages()
 
-        rule = self.rules[language]
-        phonetics_people = rule.to_phonetics_people(word)
-        hans_people = self.to_hans(phonetics_people, language, 'people')
-        phonetics_places = rule.to_phonetics_places(word)
-        hans_places = self.to_hans(phonetics_places, language, 'places')
+        result = self.lookup(word, language)
+        if result is not None:
+            return result
+
+        with profiler.stage('transliterate', language):
+            rule = self.get_rule(language)
+            with profiler.stage('to_phonetics', language):
+                phonetics_people, phonetics_places = rule.to_phonetics_both(word)
+            hans_people = self._to_hans_or_fallback(word, phonetics_people, language, 'people', failures)
+            hans_places = self._to_hans_or_fallback(word, phonetics_places, language, 'places', failures)
 
         return phonetics_people, hans_people, phonetics_places, hans_places
 
+    async def transliterate_async(self, word, language, espeak_pool, failures=None):
+        """
+        Transliterate a word without blocking the event loop on espeak or to_hans(). A word espeak did not answer fails
+        like in transliterate_batch(). The rule and lexicon of the language should be loaded beforehand, see
+        Service.load_languages().
+        :param word:
+        :param language:
+        :param espeak_pool: AsyncEspeakPool
+        :param failures: list: see transliterate_batch()
+        :return: tuple: (phonetics_people, hans_people, phonetics_places, hans_places)
+        """
+        assert isinstance(word, str) and ' ' not in word
+        assert language in self.get_supported_languages()
+
+        result = self.lookup(word, language)
+        if result is not None:
+            return result
+
+        rule = self.get_rule(language)
+        phonetics_people = await rule.to_phonetics_async(word, 'people', espeak_pool)
+        if rule.shares_phonetics:
+            phonetics_places = phonetics_people
+        else:
+            phonetics_places = await rule.to_phonetics_async(word, 'places', espeak_pool)
+        # to_hans() is CPU-bound, it runs in the default executor instead of blocking the event loop
+        hans_people, hans_places = await asyncio.get_event_loop().run_in_executor(
+            None, self._to_hans_both, word, phonetics_people, phonetics_places, language, failures)
+
+        return phonetics_people or '', hans_people, phonetics_places or '', hans_places
+
+    def _to_hans_both(self, word, phonetics_people, phonetics_places, language, failures):
+        return (self._to_hans_or_fallback(word, phonetics_people, language, 'people', failures),
+                self._to_hans_or_fallback(word, phonetics_places, language, 'places', failures))
+
+    def transliterate_batch(self, words, language, failures=None):
+        """
+        Transliterate many words at a time, phonetics of all the words are got in one go.
+        :param words: list<str>
+        :param language:
+        :param failures: list: if given, words which cannot be transliterated are appended to it as Failure, and their
+        hans are partial with FALLBACK_MARKER, instead of raising TransliterationError
+        :return: list<tuple>: (phonetics_people, hans_people, phonetics_places, hans_places) in the same order as words
+        """
+        assert isinstance(words, list) and all([isinstance(i, str) and ' ' not in i for i in words])
+        assert language in self.get_supported_languages()
+
+        results = [self.lookup(word, language) for word in words]
+        missed = [word for word, result in zip(words, results) if result is None]
+        if not missed:
+            return results
+
+        rule = self.get_rule(language)
+        with profiler.stage('to_phonetics', language):
+            phonetics_people = rule.to_phonetics_batch(missed, 'people')
+            if rule.shares_phonetics:
+                phonetics_places = phonetics_people
+            else:
+                phonetics_places = rule.to_phonetics_batch(missed, 'places')
+        transliterated = iter([(people or '', self._to_hans_or_fallback(word, people, language, 'people', failures),
+                                places or '', self._to_hans_or_fallback(word, places, language, 'places', failures))
+                               for word, people, places in zip(missed, phonetics_people, phonetics_places)])
+        return [next(transliterated) if result is None else result for result in results]
+
+    def iter_transliterate(self, words, languages, failures=None, batch_size=BATCH_SIZE):
+        """
+        Transliterate words lazily. Words are read and transliterated batch_size at a time, so that memory stays flat
+        however many words there are.
+        :param words: iterable<str>: words without spaces
+        :param languages: list<str>
+        :param failures: list: see transliterate_batch()
+        :param batch_size: int: max number of words sent to espeak at a time
+        :return: generator of TransliterationResult, in the order of words then languages
+        """
+        assert isinstance(languages, list) and all([i in self.get_supported_languages() for i in languages])
+        assert isinstance(batch_size, int) and batch_size > 0
+
+        for chunk in _chunks(words, batch_size):
+            results = {language: self.transliterate_batch(chunk, language, failures) for language in languages}
+            for i, word in enumerate(chunk):
+                for language in languages:
+                    yield TransliterationResult(word, language, *results[language][i])
+
+    def transliterate_languages(self, word, languages, failures=None):
+        """
+        Transliterate a word into many languages. Phonetics are got once per (language, method), and the espeak
+        processes of all the languages using espeak are asked at the same time.
+        :param word:
+        :param languages: list<str>
+        :param failures: list: see transliterate_batch()
+        :return: dict{language: tuple(phonetics_people, hans_people, phonetics_places, hans_places)}
+        """
+        assert isinstance(word, str) and ' ' not in word
+        assert all([i in self.get_supported_languages() for i in languages])
+
+        result = OrderedDict((language, self.lookup(word, language)) for language in OrderedDict.fromkeys(languages))
+        languages = [language for language, row in result.items() if row is None]
+        rules = {language: self.get_rule(language) for language in languages}
+        phonetics = {}  # dict{tuple(language, method name): phonetics}
+        espeak_languages = [language for language in languages
+                            if any([isinstance(rules[language].to_phonetics_backends.get(category), EspeakProcessBackend)
+                                    for category in ('people', 'places')])]
+        if espeak_languages:
+            with profiler.stage('to_phonetics'):
+                for language, ipa in espeak_for_languages(word, espeak_languages).items():
+                    for category, backend in rules[language].to_phonetics_backends.items():
+                        if isinstance(backend, EspeakProcessBackend):
+                            phonetics[(language, rules[language].to_phonetics_methods[category])] = ipa
+
+        for language in languages:
+            rule = rules[language]
+            row = []
+            with profiler.stage('transliterate', language):
+                for category in ('people', 'places'):
+                    key = (language, rule.to_phonetics_methods.get(category, category))
+                    if key not in phonetics:
+                        with profiler.stage('to_phonetics', language):
+                            phonetics[key] = getattr(rule, 'to_phonetics_' + category)(word)
+                    row.append(phonetics[key])
+                    row.append(self._to_hans_or_fallback(word, phonetics[key], language, category, failures))
+            result[language] = tuple(row)
+        return result
+
+    def _to_hans_or_fallback(self, word, phonetics, language, category, failures):
+        """
+        to_hans(), or partial hans with FALLBACK_MARKER if failures is given, then Rule.post_process()
+        :param phonetics: str, or None if espeak did not answer the word
+        """
+        if phonetics is None:
+            error = NoPhoneticsError('espeak did not answer "{}" in {} of "{}".'.format(word, category, language),
+                                     '', language, category, 0)
+            if failures is None:
+                raise error
+            failures.append(Failure(word, language, category, '', error.message))
+            return FALLBACK_MARKER
+        if failures is None:
+            hans = self.to_hans(phonetics, language, category)
+        else:
+            try:
+                hans = self.to_hans(phonetics, language, category)
+            except TransliterationError as e:
+                failures.append(Failure(word, language, category, phonetics, e.message))
+                hans = self.to_hans(phonetics, language, category, fallback=FALLBACK_MARKER)
+        with profiler.stage('post_process', language):
+            return self.get_rule(language).post_process(hans, category)
+
+
+# RulesManager of a worker process created by transliterate_many()
+_worker_rule_manager = None
+
+# Languages to transliterate into in a worker process
+_worker_languages = None
+
+
+def _init_worker(languages, verbose, profile=False):
+    global _worker_rule_manager, _worker_languages
+    sys.stdout = sys.stderr  # Output of workers should not be mixed into results printed by the main process
+    profiler.enabled = profile
+    _worker_rule_manager = RulesManager()
+    _worker_rule_manager.verbose = verbose
+    _worker_languages = languages
+    for language in languages:
+        _worker_rule_manager.get_rule(language)
+
+
+def _transliterate_chunk(args):
+    words, collect_failures = args
+    failures = [] if collect_failures else None
+    results = {language: _worker_rule_manager.transliterate_batch(words, language, failures)
+               for language in _worker_languages}
+    profile = None
+    if profiler.enabled:
+        # Sent back to be merged into the profiler of the main process
+        profile = profiler.snapshot()
+        profiler.reset()
+    return [(word, {language: results[language][i] for language in _worker_languages})
+            for i, word in enumerate(words)], profile, failures
+
+
+def _chunks(iterable, chunk_size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_transliterate_many(words, languages, workers=None, chunk_size=WORKER_CHUNK_SIZE, verbose=False,
+                            failures=None):
+    """
+    Transliterate words in parallel by a pool of worker processes.
+    Each worker loads its own rules and spawns its own espeak processes. Words are sent to workers in chunks.
+    If profiler is enabled, workers profile as well and their records are merged into profiler.
+    :param words: iterable<str>: words without spaces
+    :param languages: list<str>
+    :param workers: int: number of worker processes, default is the number of CPUs
+    :param chunk_size: int: max number of words sent to a worker at a time
+    :param verbose: RulesManager.verbose of workers
+    :param failures: list: collect Failure into it instead of raising TransliterationError,
+    see RulesManager.transliterate_batch()
+    :return: generator of (word, dict{language: (phonetics_people, hans_people, phonetics_places, hans_places)}),
+    in the same order as words
+    """
+    assert isinstance(languages, list) and languages
+    assert isinstance(chunk_size, int) and chunk_size > 0
+
+    workers = workers or os.cpu_count() or 1
+    # Workers are spawned instead of forked, so that they do not share espeak processes with the main process
+    pool = multiprocessing.get_context('spawn').Pool(workers, initializer=_init_worker,
+                                                     initargs=(languages, verbose, profiler.enabled))
+    try:
+        chunks = ((chunk, failures is not None) for chunk in _chunks(words, chunk_size))
+        for results, profile, chunk_failures in pool.imap(_transliterate_chunk, chunks):
+            if profile is not None:
+                profiler.merge(profile)
+            if chunk_failures:
+                failures.extend(chunk_failures)
+            for word_and_result in results:
+                yield word_and_result
+    except BaseException:
+        # Including GeneratorExit if the caller stops early
+        pool.terminate()
+        raise
+    # Workers exit by themselves, so that their IPA caches are flushed at exit
+    pool.close()
+    pool.join()
+
+
+def transliterate_many(words, languages, workers=None, chunk_size=WORKER_CHUNK_SIZE, verbose=False, failures=None):
+    """
+    Transliterate words in parallel by a pool of worker processes. See iter_transliterate_many().
+    :return: list<dict{language: (phonetics_people, hans_people, phonetics_places, hans_places)}>,
+    in the same order as words
+    """
+    return [result for word, result in iter_transliterate_many(words, languages, workers, chunk_size, verbose,
+                                                                failures)]
+
 
 class PPAT(object):
     """
@@ -498,6 +1570,12 @@ class PPAT(object):
                 self.rule_manager.verbose = False
             else:
                 print('Invalid value "{}". Usage: :config verbose <on|off>'.format(items[2]))
+        elif items[1] == 'profile':
+            if len(items) != 3 or items[2] not in ('on', 'off'):
+                print('Usage: :config profile <on|off>')
+                return
+            profiler.enabled = items[2] == 'on'
+            profiler.reset()
         elif items[1] == 'languages':
             if len(items) < 3:
                 print('Please specify one language at least. See all available languages by typing ":lang".')
@@ -519,15 +1597,31 @@ class PPAT(object):
                            'ON' if language_code in self.activated_languages else 'OFF'
                            ])
             print(x)
+        elif command.split(' ')[0] in ('reload', 'r', ):
+            self.reload(command.split()[1:])
         elif command.startswith('c') or command.startswith('config'):
             self.config(command)
         else:
             print('Invalid command "{}". Type ":help" for more instructions.'.format(command))
 
+    def reload(self, languages):
+        reloaded = []
+        try:
+            if not languages:
+                reloaded = self.rule_manager.reload()
+            for language in languages:
+                reloaded += self.rule_manager.reload(language)
+        except Exception as e:
+            print('Failed to reload, the loaded rules are kept: {}'.format(e))
+            return
+        print('Reloaded: {}.'.format(' '.join(reloaded)) if reloaded else 'Nothing changed.')
+
     def cli(self, _verbose=False):
         print(WELCOME)
         self.rule_manager = RulesManager()
         self.rule_manager.verbose = _verbose
+        for language in self.activated_languages:
+            self.rule_manager.get_rule(language)
         print(READY)
         while True:
             word = input('> ')
@@ -539,17 +1633,162 @@ class PPAT(object):
                 self.transliterate(word)
         print(BYE)
 
+    def batch(self, input_file, output_file, output_format='tsv', languages=None, workers=1, failures=None):
+        """
+        Transliterate every word of input_file non-interactively and stream the results to output_file.
+        Rule files are loaded only once, messages go to stderr so that output_file can be stdout.
+        A word which cannot be transliterated does not stop the batch, its hans are partial with FALLBACK_MARKER.
+        :param input_file: a text file object, one word per line
+        :param output_file: a text file object
+        :param output_format: one of BATCH_FORMATS
+        :param languages: list<str>: languages to transliterate into, default is self.activated_languages
+        :param workers: int: number of worker processes, transliterate in the current process if 1
+        :param failures: list: Failure of the words which cannot be transliterated are appended to it
+        :return: int: number of words transliterated
+        """
+        if self.rule_manager is None:
+            self.rule_manager = RulesManager()
+        languages = languages or self.activated_languages
+        for language in languages:
+            if language not in self.rule_manager.get_supported_languages():
+                raise ValueError('Invalid language code "{}".'.format(language))
+            with contextlib.redirect_stdout(sys.stderr):
+                self.rule_manager.get_rule(language)
+        write = get_batch_writer(output_file, output_format)
+        count = 0
+        if failures is None:
+            failures = []
+        if workers != 1:
+            words = self._valid_batch_words(input_file)
+            for word, result in iter_transliterate_many(words, languages, workers, verbose=self.rule_manager.verbose,
+                                                        failures=failures):
+                for language in languages:
+                    write([word, language] + list(result[language]))
+                count += 1
+            return count
+        for result in self.rule_manager.iter_transliterate(self._valid_batch_words(input_file), languages, failures):
+            write(result)
+            count += 1
+        return count // len(languages)
+
+    @staticmethod
+    def _valid_batch_words(input_file):
+        for line_number, word in read_batch_words(input_file):
+            if ' ' in word:
+                print('Skipped "{}" at line {}: word cannot contain spaces.'.format(word, line_number),
+                      file=sys.stderr)
+                continue
+            yield word
+
     def transliterate(self, word):
         if ' ' in word:
             print('Word cannot contain spaces.')
             return
         x = PrettyTable()
         x.field_names = ['Language', 'Phonetics(people)', 'Chinese(people)', 'Phonetics(places)', 'Chinese(places)']
-        for language in self.activated_languages:
-            row = [self.rule_manager.get_supported_language_full_name(language)]+\
-                    list(self.rule_manager.transliterate(word, language))
-            x.add_row(row)
+        failures = []
+        for language, row in self.rule_manager.transliterate_languages(word, self.activated_languages,
+                                                                       failures).items():
+            x.add_row([self.rule_manager.get_supported_language_full_name(language)] + list(row))
         print(x)
+        for failure in failures:
+            print(failure.error)
+        if profiler.enabled:
+            print(profiler.report())
+            profiler.reset()
+
+
+def get_argument_parser():
+    parser = argparse.ArgumentParser(prog='ppat', description='Places & People Automate Transliterator')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('verbose', help='Start the interactive shell in verbose mode.')
+    batch_parser = subparsers.add_parser('batch', help='Transliterate words from a file or stdin, one word per line.')
+    batch_parser.add_argument('input', nargs='?', default='-', help='Input file, "-" for stdin. Default: "-".')
+    batch_parser.add_argument('-o', '--output', default='-', help='Output file, "-" for stdout. Default: "-".')
+    batch_parser.add_argument('-f', '--format', choices=BATCH_FORMATS, default='tsv', help='Default: tsv.')
+    batch_parser.add_argument('-l', '--languages', nargs='+', default=DEFAULT_ACTIVATED_LANGUAGES,
+                              help='Languages to transliterate into. Default: {}.'.format(
+                                  ' '.join(DEFAULT_ACTIVATED_LANGUAGES)))
+    batch_parser.add_argument('-j', '--workers', type=int, default=1,
+                              help='Number of worker processes, 0 for the number of CPUs. Default: 1.')
+    batch_parser.add_argument('--failures', metavar='PATH',
+                              help='Write words which cannot be transliterated to a TSV report, which can be used as '
+                                   'input to retry them. Default: print them to stderr.')
+    batch_parser.add_argument('--profile', action='store_true',
+                              help='Print time spent per stage to stderr at the end.')
+    lint_parser = subparsers.add_parser('lint', help='Report shadowed match rules and unused or missing coords.')
+    lint_parser.add_argument('-l', '--languages', nargs='+', help='Default: all languages.')
+    serve_parser = subparsers.add_parser('serve', help='Serve transliteration over HTTP/JSON.')
+    serve_parser.add_argument('--host', default='127.0.0.1', help='Default: 127.0.0.1.')
+    serve_parser.add_argument('--port', type=int, default=8000, help='Default: 8000.')
+    serve_parser.add_argument('--unix', metavar='PATH', help='Serve on a Unix socket instead of host:port.')
+    serve_parser.add_argument('-l', '--languages', nargs='+', default=DEFAULT_ACTIVATED_LANGUAGES,
+                              help='Languages loaded at startup and used by default. Default: {}.'.format(
+                                  ' '.join(DEFAULT_ACTIVATED_LANGUAGES)))
+    serve_parser.add_argument('--children', type=int, default=2,
+                              help='Number of espeak processes per language. Default: 2.')
+    serve_parser.add_argument('-q', '--quiet', action='store_true', help='Do not log requests.')
+    serve_parser.add_argument('--watch', action='store_true',
+                              help='Reload the rule files of the loaded languages when they are edited.')
+    return parser
+
+
+def batch(args):
+    ppat = PPAT()
+    profiler.enabled = args.profile
+    input_file = sys.stdin if args.input == '-' else open(args.input, 'r', encoding='utf-8-sig')
+    # Paradox games read localisation files only with BOM
+    encoding = 'utf-8-sig' if args.format == 'yml' else 'utf8'
+    output_file = sys.stdout if args.output == '-' else open(args.output, 'w', encoding=encoding, newline='')
+    failures = []
+    try:
+        count = ppat.batch(input_file, output_file, args.format, args.languages, args.workers or None, failures)
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+        if output_file is not sys.stdout:
+            output_file.close()
+    print('{} word(s) transliterated.'.format(count), file=sys.stderr)
+    if failures:
+        print('{} failure(s), marked by "{}" in the results.'.format(len(failures), FALLBACK_MARKER), file=sys.stderr)
+        if args.failures:
+            with open(args.failures, 'w', encoding='utf8', newline='') as f:
+                write_failures(failures, f)
+            print('Failures are written to {}.'.format(args.failures), file=sys.stderr)
+        else:
+            for failure in failures:
+                print('Failed "{}": {}'.format(failure.word, failure.error), file=sys.stderr)
+    if args.profile:
+        print(profiler.report(), file=sys.stderr)
+
+
+def lint(args):
+    rule_manager = RulesManager()
+    languages = args.languages or sorted(rule_manager.get_supported_languages())
+    count = 0
+    for language in languages:
+        if language not in rule_manager.get_supported_languages():
+            print('Invalid language code "{}".'.format(language), file=sys.stderr)
+            sys.exit(2)
+        with contextlib.redirect_stdout(sys.stderr), contextlib.redirect_stderr(io.StringIO()):
+            rule = rule_manager.get_rule(language)
+        for message in rule.lint():
+            print(message)
+            count += 1
+    print('{} problem(s) found in {} language(s).'.format(count, len(languages)), file=sys.stderr)
+    if count:
+        sys.exit(1)
+
+
+def serve(args):
+    from .pespeak import AsyncEspeakPool
+    from .service import DEFAULT_WATCH_INTERVAL, Service
+    with contextlib.redirect_stdout(sys.stderr):
+        service = Service(espeak_pool=AsyncEspeakPool(children_per_language=args.children),
+                          languages=args.languages, quiet=args.quiet,
+                          watch_interval=DEFAULT_WATCH_INTERVAL if args.watch else None)
+    service.serve_forever(args.host, args.port, args.unix)
+
 
 def main():
     if sys.getdefaultencoding() != 'utf-8':
@@ -562,7 +1801,17 @@ def main():
         """
         )
         exit(0)
-    verbose = True if 'verbose' in sys.argv[1:] else False
+    args = get_argument_parser().parse_args()
+    if args.command == 'batch':
+        batch(args)
+        return
+    if args.command == 'serve':
+        serve(args)
+        return
+    if args.command == 'lint':
+        lint(args)
+        return
+    verbose = True if args.command == 'verbose' else False
     ppat = PPAT()
     ppat.cli(verbose)
 
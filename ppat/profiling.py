@@ -0,0 +1,129 @@
+"""
+Time spent per stage of transliterating, for finding out whether a language is bound by espeak or by its rule table
+
+Stages are recorded only when profiler.enabled is True. Hot loops check profiler.enabled themselves, other places use
+"with profiler.stage(name, language):", which costs a method call when disabled.
+"""
+import threading
+import time
+
+# Stages in the order of a report, others follow in alphabetical order
+STAGES = ('transliterate', 'to_phonetics', 'espeak io', 'to_hans', 'longest prefix match', 'rule check',
+          'post_process')
+
+
+class _Stage(object):
+    """
+    A context manager adding the time spent in it to a stage of a profiler
+    """
+
+    def __init__(self, profiler, key):
+        self._profiler = profiler
+        self._key = key
+        self._start = 0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._profiler.add_time(self._key, time.perf_counter() - self._start)
+
+
+class _NoStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NO_STAGE = _NoStage()
+
+
+class Profiler(object):
+    """
+    Accumulated time per (language, stage) and counters per (language, counter). It is safe to share across threads.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.stages = {}  # dict{tuple(language, stage): list[calls, seconds]}
+        self.counters = {}  # dict{tuple(language, counter): int}
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+            self.counters = {}
+
+    def stage(self, name, language=None):
+        """
+        :return: a context manager timing the code in it
+        """
+        if not self.enabled:
+            return _NO_STAGE
+        return _Stage(self, (language, name))
+
+    def add_time(self, key, seconds, calls=1):
+        """
+        :param key: tuple(language, stage)
+        """
+        with self._lock:
+            stage = self.stages.setdefault(key, [0, 0.0])
+            stage[0] += calls
+            stage[1] += seconds
+
+    def count(self, key, n=1):
+        """
+        :param key: tuple(language, counter)
+        """
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def snapshot(self):
+        """
+        :return: dict, which can be pickled and merged into another profiler
+        """
+        with self._lock:
+            return {'stages': {k: list(v) for k, v in self.stages.items()}, 'counters': dict(self.counters)}
+
+    def merge(self, snapshot):
+        for key, (calls, seconds) in snapshot['stages'].items():
+            self.add_time(key, seconds, calls)
+        for key, n in snapshot['counters'].items():
+            self.count(key, n)
+
+    def report(self):
+        """
+        :return: str: a table of stages and counters per language
+        """
+        snapshot = self.snapshot()
+        if not snapshot['stages'] and not snapshot['counters']:
+            return 'Nothing profiled.'
+
+        def order(key):
+            language, name = key
+            return (language or '', STAGES.index(name) if name in STAGES else len(STAGES), name)
+
+        lines = ['{:<10}{:<24}{:>10}{:>14}{:>14}'.format('language', 'stage', 'calls', 'total(ms)', 'mean(us)')]
+        for key in sorted(snapshot['stages'].keys(), key=order):
+            calls, seconds = snapshot['stages'][key]
+            lines.append('{:<10}{:<24}{:>10}{:>14.2f}{:>14.2f}'.format(key[0] or '-', key[1], calls, seconds * 1000,
+                                                                     seconds / calls * 1e6 if calls else 0))
+        counters = snapshot['counters']
+        if counters:
+            lines.append('')
+            lines.append('{:<10}{:<24}{:>10}'.format('language', 'counter', 'count'))
+            for key in sorted(counters.keys(), key=order):
+                lines.append('{:<10}{:<24}{:>10}'.format(key[0] or '-', key[1], counters[key]))
+            for language in sorted(set(language for language, name in counters.keys()), key=lambda i: i or ''):
+                segments = counters.get((language, 'segments'), 0)
+                if segments:
+                    lines.append('{:<10}{:<24}{:>10.2f}'.format(language or '-', 'candidates per segment',
+                                                                counters.get((language, 'candidates'), 0) / segments))
+        return '\n'.join(lines)
+
+
+profiler = Profiler()
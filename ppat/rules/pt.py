@@ -1,13 +0,0 @@
-def post_process_people(word):
-    """
-    无特殊规则
-    """
-    
-    return word
-
-
-def post_process_places(word):
-    """
-    无特殊规则
-    """
-    return word
@@ -0,0 +1,247 @@
+"""
+Long-running HTTP/JSON service of PPAT
+
+Rules and espeak processes are kept warm, so that tools can call one process instead of starting PPAT repeatedly.
+
+GET  /languages              Supported languages and their full names.
+GET  /stats                  Number of requests and latency of the service.
+POST /transliterate          {"word": "London", "languages": ["en-us"]}
+                             or {"words": ["London", "Paris"], "languages": ["en-us", "fr"]}
+                             Words which cannot be transliterated, or which espeak did not answer in time, are
+                             listed in "failures" of the response.
+
+With a watch interval, edited rule files of the loaded languages are reloaded without restarting the service.
+"""
+import asyncio
+import contextlib
+import json
+import sys
+import time
+from http.client import responses
+
+from .pespeak import AsyncEspeakPool
+from .ppat import BATCH_FIELDS, DEFAULT_ACTIVATED_LANGUAGES, RulesManager, get_source_mtimes
+
+DEFAULT_HOST = '127.0.0.1'
+
+DEFAULT_PORT = 8000
+
+# Max size of a request body
+MAX_BODY_SIZE = 16 * 1024 * 1024
+
+# Max number of words in a request
+MAX_WORDS_NUMBER = 100000
+
+# Seconds between checks for edited rule files, see Service.watch_rules()
+DEFAULT_WATCH_INTERVAL = 1.0
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message):
+        super(HTTPError, self).__init__(message)
+        self.status = status
+        self.message = message
+
+
+class Service(object):
+    """
+    Transliterate words over HTTP with a shared RulesManager and AsyncEspeakPool
+    """
+
+    def __init__(self, rule_manager=None, espeak_pool=None, languages=None, quiet=False, watch_interval=None):
+        """
+        :param rule_manager: RulesManager
+        :param espeak_pool: AsyncEspeakPool
+        :param languages: list<str>: default languages of requests, their rules are loaded at once
+        :param quiet: do not log requests to stderr
+        :param watch_interval: float: seconds between checks for edited rule files, do not check if None
+        """
+        self.rule_manager = rule_manager or RulesManager()
+        self.espeak_pool = espeak_pool or AsyncEspeakPool()
+        self.languages = languages or DEFAULT_ACTIVATED_LANGUAGES
+        self.quiet = quiet
+        self.watch_interval = watch_interval
+        self.reloads = 0
+        self.requests = 0
+        self.words = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        for language in self.languages:
+            self.load_language(language)
+
+    def load_language(self, language):
+        self.rule_manager.get_rule(language)
+        self.rule_manager.get_lexicon(language)
+
+    async def load_languages(self, languages):
+        """
+        Load the rules and lexicons of languages in the default executor, so that other requests are served meanwhile
+        """
+        loop = asyncio.get_event_loop()
+        await asyncio.gather(*[loop.run_in_executor(None, self.load_language, language) for language in set(languages)
+                               if language not in self.rule_manager.rules
+                               or language not in self.rule_manager.lexicons])
+
+    def log(self, method, path, status, latency):
+        if not self.quiet:
+            print('{} {} {} {:.2f}ms'.format(method, path, status, latency * 1000), file=sys.stderr)
+
+    def reload_changed_rules(self):
+        """
+        Reload the loaded languages whose rule files have changed. A rule file which cannot be parsed is reported, and
+        its loaded rule keeps serving.
+        """
+        for language in self.rule_manager.changed_languages():
+            try:
+                with contextlib.redirect_stdout(sys.stderr):
+                    self.rule_manager.reload(language)
+                self.reloads += 1
+                print('Reloaded rules of "{}".'.format(language), file=sys.stderr)
+            except Exception as e:
+                # Not tried again until the file changes again
+                self.rule_manager.source_mtimes[language] = get_source_mtimes(language)
+                print('Failed to reload rules of "{}", the loaded rules are kept: {}'.format(language, e),
+                      file=sys.stderr)
+
+    async def watch_rules(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            await loop.run_in_executor(None, self.reload_changed_rules)
+
+    async def transliterate(self, body):
+        try:
+            request = json.loads(body.decode('utf8'))
+        except ValueError:
+            raise HTTPError(400, 'Request body should be a JSON object.')
+        if not isinstance(request, dict):
+            raise HTTPError(400, 'Request body should be a JSON object.')
+        words = request.get('words', [request['word']] if 'word' in request else None)
+        languages = request.get('languages', self.languages)
+        if not isinstance(words, list) or not all(isinstance(i, str) for i in words):
+            raise HTTPError(400, '"word" should be a string, or "words" should be a list of strings.')
+        if len(words) > MAX_WORDS_NUMBER:
+            raise HTTPError(400, 'Too many words, {} at most.'.format(MAX_WORDS_NUMBER))
+        if not isinstance(languages, list) or not languages:
+            raise HTTPError(400, '"languages" should be a list of language codes.')
+        for language in languages:
+            if language not in self.rule_manager.get_supported_languages():
+                raise HTTPError(400, 'Invalid language code "{}".'.format(language))
+        for word in words:
+            if word.split() != [word] or not word.isprintable():
+                raise HTTPError(400, 'Invalid word {}. Word should be a single token of printable characters.'
+                                .format(json.dumps(word)))
+        await self.load_languages(languages)
+        failures = []
+        results = await asyncio.gather(*[self.rule_manager.transliterate_async(word, language, self.espeak_pool,
+                                                                               failures)
+                                         for word in words for language in languages])
+        self.words += len(words)
+        pairs = [(word, language) for word in words for language in languages]
+        return {'results': [dict(zip(BATCH_FIELDS, [word, language] + list(result)))
+                            for (word, language), result in zip(pairs, results)],
+                'failures': [dict(failure._asdict()) for failure in failures]}
+
+    def stats(self):
+        return {'requests': self.requests,
+                'words': self.words,
+                'average_latency_ms': self.total_latency / self.requests * 1000 if self.requests else 0,
+                'max_latency_ms': self.max_latency * 1000,
+                'loaded_languages': sorted(self.rule_manager.rules.keys()),
+                'reloads': self.reloads}
+
+    async def dispatch(self, method, path, body):
+        path = path.split('?')[0]
+        if path == '/transliterate':
+            if method != 'POST':
+                raise HTTPError(405, 'Use POST for /transliterate.')
+            return await self.transliterate(body)
+        if path == '/languages':
+            return {'languages': self.rule_manager.get_supported_languages_and_full_names()}
+        if path == '/stats':
+            return self.stats()
+        raise HTTPError(404, 'No such path "{}".'.format(path))
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                start = time.perf_counter()
+                try:
+                    method, path, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    k, _, v = line.decode('latin-1').partition(':')
+                    headers[k.strip().lower()] = v.strip()
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close' \
+                    or headers.get('connection', '').lower() == 'keep-alive'
+                try:
+                    length = int(headers.get('content-length', 0))
+                    if length > MAX_BODY_SIZE:
+                        raise HTTPError(413, 'Request body is too large.')
+                    body = await reader.readexactly(length) if length > 0 else b''
+                    status, response = 200, await self.dispatch(method, path, body)
+                except HTTPError as e:
+                    status, response = e.status, {'error': e.message}
+                except Exception as e:
+                    status, response = 500, {'error': '{}: {}'.format(type(e).__name__, e)}
+                latency = time.perf_counter() - start
+                self.requests += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                response['latency_ms'] = latency * 1000
+                data = json.dumps(response, ensure_ascii=False).encode('utf8')
+                writer.write('HTTP/1.1 {} {}\r\n'
+                             'Content-Type: application/json; charset=utf-8\r\n'
+                             'Content-Length: {}\r\n'
+                             'X-Response-Time: {:.3f}ms\r\n'
+                             'Connection: {}\r\n\r\n'
+                             .format(status, responses.get(status, ''), len(data), latency * 1000,
+                                     'keep-alive' if keep_alive else 'close').encode('latin-1') + data)
+                await writer.drain()
+                self.log(method, path, status, latency)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT, unix_socket=None):
+        """
+        Serve on host:port, or on a Unix socket if unix_socket is given, until cancelled
+        """
+        if unix_socket:
+            server = await asyncio.start_unix_server(self.handle_connection, unix_socket)
+            print('PPAT is serving on {}'.format(unix_socket), file=sys.stderr)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port)
+            print('PPAT is serving on http://{}:{}'.format(host, port), file=sys.stderr)
+        watcher = None
+        if self.watch_interval:
+            watcher = asyncio.create_task(self.watch_rules())
+        try:
+            await server.serve_forever()
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            server.close()
+            await server.wait_closed()
+            await self.espeak_pool.close()
+
+    def serve_forever(self, host=DEFAULT_HOST, port=DEFAULT_PORT, unix_socket=None):
+        """
+        Run serve() in a new event loop until interrupted
+        """
+        try:
+            asyncio.run(self.serve(host, port, unix_socket))
+        except KeyboardInterrupt:
+            pass
@@ -30,7 +30,7 @@ setup(name='ppat',
       url='https://github.com/EnderQIU/ppat',
       install_requires=install_requires,
       packages=['ppat', 'ppat.rules'],
-      package_data={'ppat': ['rules/*.rule']},
+      package_data={'ppat': ['rules/*.rule', 'rules/*.dict']},
       include_package_data=True,
       entry_points={
           'console_scripts': [
@@ -0,0 +1,28 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from ppat import lexicon, ppat
+from ppat.cache import IPACache
+from ppat.pespeak import EspeakProcessManager
+
+
+class TemporaryCachesTestCase(unittest.TestCase):
+    """
+    The rule, lexicon and IPA caches are written to a temporary directory instead of CACHE_DIR, by worker processes
+    as well
+    """
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir, ignore_errors=True)
+        self.ipa_cache = IPACache(os.path.join(self.cache_dir, 'ipa.sqlite3'))
+        self.addCleanup(self.ipa_cache.close)
+        for patcher in [mock.patch.object(ppat, 'RULE_CACHE_DIR', os.path.join(self.cache_dir, 'rules')),
+                        mock.patch.object(lexicon, 'LEXICON_CACHE_DIR', os.path.join(self.cache_dir, 'lexicons')),
+                        mock.patch.object(EspeakProcessManager, 'ipa_cache', self.ipa_cache),
+                        mock.patch.dict(os.environ, {'PPAT_CACHE_DIR': self.cache_dir})]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
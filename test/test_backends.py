@@ -0,0 +1,111 @@
+import types
+import unittest
+from unittest import mock
+
+from ppat import backends
+from ppat.backends import LibEspeak, PhoneticsBackend, get_backend, get_libespeak, register_backend
+from ppat.ppat import RulesManager
+from test import TemporaryCachesTestCase
+
+
+class BackendsTestCase(TemporaryCachesTestCase):
+
+    def tearDown(self):
+        backends.BACKENDS.pop('reverse', None)
+        backends.BACKENDS.pop('counting', None)
+
+    def test_get_backend(self):
+        self.assertEqual(get_backend('lowercase', 'es').to_phonetics_batch(['Juan', 'Madrid']), ['juan', 'madrid'])
+        self.assertIsNone(get_backend('post_process_people', 'es'))
+
+    def test_register_backend(self):
+        @register_backend('reverse')
+        class ReverseBackend(PhoneticsBackend):
+            def to_phonetics(self, word):
+                return word[::-1]
+
+        rule = RulesManager().get_rule('es')
+        rule.set_to_phonetics('people', 'reverse')
+        self.assertEqual(rule.to_phonetics_people('abc'), 'cba')
+        self.assertEqual(rule.to_phonetics_batch(['ab', 'cd'], 'people'), ['ba', 'dc'])
+
+    def test_shared_phonetics(self):
+        words = []
+
+        @register_backend('counting')
+        class CountingBackend(PhoneticsBackend):
+            def to_phonetics(self, word):
+                words.append(word)
+                return word.lower()
+
+        rule_manager = RulesManager()
+        rule = rule_manager.get_rule('es')
+        rule.set_to_phonetics('people', 'counting')
+        rule.set_to_phonetics('places', 'counting')
+        self.assertTrue(rule.shares_phonetics)
+        self.assertEqual(rule_manager.transliterate('Juan', 'es'), ('juan', '胡安', 'juan', '胡安'))
+        self.assertEqual(rule_manager.transliterate_languages('Juan', ['es', 'es']),
+                         {'es': ('juan', '胡安', 'juan', '胡安')})
+        self.assertEqual(words, ['Juan', 'Juan'])
+        rule.set_to_phonetics('places', 'copy')
+        self.assertFalse(rule.shares_phonetics)
+        self.assertEqual(rule.to_phonetics_both('Juan'), ('juan', 'Juan'))
+
+
+def fake_library(ng, phoneme_modes):
+    """
+    A library of the libespeak API, answers every word by "hɛloʊ"
+    """
+    def text_to_phonemes(text_pointer, text_mode, phoneme_mode):
+        phoneme_modes.append(phoneme_mode)
+        text_pointer._obj.value = None
+        return 'hɛloʊ'.encode('utf8')
+
+    library = types.SimpleNamespace(espeak_Initialize=lambda *args: 22050, espeak_SetVoiceByName=lambda name: 0,
+                                    espeak_TextToPhonemes=text_to_phonemes, espeak_Info=lambda path_data: b'1.48.15')
+    if ng:
+        library.espeak_ng_InitializePath = lambda path: None
+    return library
+
+
+class LibEspeakTestCase(unittest.TestCase):
+
+    def test_ipa_flag(self):
+        phoneme_modes = []
+        self.assertEqual(LibEspeak(fake_library(False, phoneme_modes)).to_ipa('hello', 'en-us'),
+                         'hɛloʊ'.encode('utf8'))
+        LibEspeak(fake_library(True, phoneme_modes)).to_ipa('hello', 'en-us')
+        self.assertEqual(phoneme_modes, [0x10, 0x02])  # espeak 1.48, then espeak-ng
+
+    @mock.patch.dict(backends.__LIBESPEAK__, clear=True)
+    def test_bundled_library_first(self):
+        with mock.patch.object(backends.os.path, 'exists', return_value=True), \
+                mock.patch.object(backends.ctypes, 'CDLL', return_value=fake_library(False, [])) as cdll, \
+                mock.patch.object(backends.ctypes.util, 'find_library', side_effect=AssertionError('not bundled')):
+            self.assertIsInstance(get_libespeak(), LibEspeak)
+            self.assertIs(get_libespeak(), get_libespeak())
+            self.assertIs(get_libespeak(system=True), get_libespeak())
+        cdll.assert_called_once_with(backends.LIBESPEAK_PATHS[0])
+
+    @mock.patch.dict(backends.__LIBESPEAK__, clear=True)
+    def test_system_library_on_demand(self):
+        with mock.patch.object(backends.os.path, 'exists', return_value=False), \
+                mock.patch.object(backends.ctypes, 'CDLL', return_value=fake_library(True, [])) as cdll, \
+                mock.patch.object(backends.ctypes.util, 'find_library', return_value='libespeak-ng.so.1'):
+            self.assertIsNone(get_libespeak())
+            self.assertIsInstance(get_backend('espeak', 'en-us'), backends.EspeakProcessBackend)
+            self.assertIsInstance(get_backend('libespeak', 'en-us'), backends.LibEspeakBackend)
+        cdll.assert_called_once_with('libespeak-ng.so.1')
+
+
+class LibEspeakBackendTestCase(TemporaryCachesTestCase):
+
+    @mock.patch.dict(backends.__LIBESPEAK__, clear=True)
+    def test_ipa_cache(self):
+        phoneme_modes = []
+        backends.__LIBESPEAK__[True] = LibEspeak(fake_library(True, phoneme_modes))
+        backend = get_backend('libespeak', 'en-us')
+        self.assertEqual(backend.to_phonetics_batch(['hello', 'hello']), ['hɛloʊ', 'hɛloʊ'])
+        self.assertEqual(backend.to_phonetics('hello'), 'hɛloʊ')
+        self.assertEqual(len(phoneme_modes), 1)
+        self.assertEqual(self.ipa_cache.get('libespeak 1.48.15', 'en-us', 'hello'), 'hɛloʊ'.encode('utf8'))
@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ppat.cache import LRUCache, IPACache
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_evict_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+
+
+class IPACacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.cache_dir, 'ipa.sqlite3')
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_persistent(self):
+        cache = IPACache(self.path)
+        cache.put_many('1.48', 'en-us', [('her', b'h\xc9\x9c\xcb\x90')])
+        cache.put('1.48', 'de', 'her', b'he:r')
+        cache.close()
+
+        cache = IPACache(self.path)
+        self.assertEqual(cache.get('1.48', 'en-us', 'her'), b'h\xc9\x9c\xcb\x90')
+        self.assertEqual(cache.get_many('1.48', 'de', ['her', 'him']), {'her': b'he:r'})
+        self.assertIsNone(cache.get('1.49', 'en-us', 'her'))
+        cache.close()
+
+    def test_memory_only_if_unavailable(self):
+        with open(self.path, 'w'):
+            pass
+        cache = IPACache(os.path.join(self.path, 'not_a_directory', 'ipa.sqlite3'))
+        cache.put('1.48', 'en-us', 'her', b'x')
+        self.assertEqual(cache.get('1.48', 'en-us', 'her'), b'x')
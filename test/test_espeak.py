@@ -0,0 +1,199 @@
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import pexpect
+
+from ppat import pespeak
+from ppat.pespeak import AsyncEspeakPool, EspeakError, EspeakProcessManager, EspeakProcessPool
+from ppat.ppat import FALLBACK_MARKER, RulesManager
+from test import TemporaryCachesTestCase
+
+FAKE_ESPEAK_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmark',
+                                'fake_espeak.py')
+
+
+class FakeEspeakTestCase(TemporaryCachesTestCase):
+    """
+    espeak is replaced by benchmark/fake_espeak.py
+    """
+
+    def setUp(self):
+        super(FakeEspeakTestCase, self).setUp()
+        command = '{} {}'.format(sys.executable, FAKE_ESPEAK_PATH)
+        self.pool = EspeakProcessPool(idle_timeout=None)
+        for patcher in [mock.patch.object(pespeak, 'ESPEAK_INTERACT_COMMAND', command + ' --ipa -q -v {}'),
+                        mock.patch.object(pespeak, 'ESPEAK_VERSION_COMMAND', command + ' --version'),
+                        mock.patch.object(pespeak, 'ESPEAK_VOICES_COMMAND', command + ' --voices'),
+                        mock.patch.object(pespeak, 'DEBUG', False),
+                        mock.patch.object(pespeak, '__ESPEAK_VERSION__', None),
+                        mock.patch.dict(pespeak.__SUPPORTED_LANGUAGES__, clear=True),
+                        mock.patch.dict(pespeak.__SENTINEL_IPA__, clear=True),
+                        mock.patch.object(EspeakProcessManager, 'pool', self.pool)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.pool.close)  # Before the patches are stopped
+
+
+class ToIpaBatchTestCase(FakeEspeakTestCase):
+
+    def test_to_ipa_batch(self):
+        manager = EspeakProcessManager()
+        self.assertEqual(manager.to_ipa_batch(['London', 'Paris', 'London'], 'en-us'),
+                         ['ˈlʌndən'.encode('utf8'), 'ˈpæɹɪs'.encode('utf8'), 'ˈlʌndən'.encode('utf8')])
+
+    def test_word_without_answer(self):
+        # fake_espeak.py answers a blank line by no line, the answers after it are not shifted
+        manager = EspeakProcessManager()
+        self.assertEqual(manager.to_ipa_batch(['London', '\t', 'Paris'], 'en-us'),
+                         ['ˈlʌndən'.encode('utf8'), None, 'ˈpæɹɪs'.encode('utf8')])
+        self.assertIsNone(self.ipa_cache.get(pespeak.get_espeak_version(), 'en-us', '\t'))
+
+    def test_fallback_timeout(self):
+        manager = EspeakProcessManager()
+
+        def to_ipa_for_language(word, language):
+            if word == 'Paris':
+                raise pexpect.TIMEOUT('espeak hung')
+            return b'ipa'
+
+        with mock.patch.object(pespeak, '_run_espeak_batch', return_value=[]), \
+                mock.patch.object(manager, 'to_ipa_for_language', side_effect=to_ipa_for_language):
+            self.assertEqual(manager.to_ipa_batch(['London', 'Paris'], 'en-us'), [b'ipa', None])
+
+    def test_batch_timeout(self):
+        manager = EspeakProcessManager()
+        pespeak.get_espeak_version(), pespeak.get_supported_languages()  # Before espeak times out
+        with mock.patch.object(pespeak.subprocess, 'run', side_effect=subprocess.TimeoutExpired('espeak', 3)):
+            self.assertEqual(manager.to_ipa_batch(['London', 'Paris'], 'en-us'),
+                             ['ˈlʌndən'.encode('utf8'), 'ˈpæɹɪs'.encode('utf8')])
+
+    def test_sentinel_word(self):
+        manager = EspeakProcessManager()
+        with mock.patch.object(pespeak, '_run_espeak_batch', wraps=pespeak._run_espeak_batch) as run_espeak_batch:
+            self.assertEqual(manager.to_ipa_batch(['London', 'PpatSentinel', 'Paris'], 'en-us'),
+                             ['ˈlʌndən'.encode('utf8'), 'ˈppatsentinel'.encode('utf8'), 'ˈpæɹɪs'.encode('utf8')])
+        run_espeak_batch.assert_called_once_with('en-us', ['London', 'Paris'])
+
+    def test_transliterate_batch_failure(self):
+        failures = []
+        rule_manager = RulesManager()
+        rule_manager.lexicons['en-us'] = None
+        result = rule_manager.transliterate_batch(['\t'], 'en-us', failures)
+        self.assertEqual(result, [('', FALLBACK_MARKER, '', FALLBACK_MARKER)])
+        self.assertEqual([(i.word, i.category) for i in failures], [('\t', 'people'), ('\t', 'places')])
+
+
+class IpaCacheTestCase(FakeEspeakTestCase):
+
+    def test_cache_hit_skips_espeak(self):
+        manager = EspeakProcessManager()
+        ipa = manager.to_ipa_for_language('London', 'en-us')
+        self.assertEqual(self.ipa_cache.get(pespeak.get_espeak_version(), 'en-us', 'London'), ipa)
+        with mock.patch.object(self.pool, 'get_process', side_effect=AssertionError('espeak is asked')):
+            self.assertEqual(manager.to_ipa_for_language('London', 'en-us'), ipa)
+
+    def test_batch_asks_missed_words_only(self):
+        manager = EspeakProcessManager()
+        self.ipa_cache.put(pespeak.get_espeak_version(), 'en-us', 'London', b'cached')
+        with mock.patch.object(pespeak, '_run_espeak_batch', return_value=[b'paris']) as run_espeak_batch:
+            self.assertEqual(manager.to_ipa_batch(['London', 'Paris'], 'en-us'), [b'cached', b'paris'])
+        run_espeak_batch.assert_called_once_with('en-us', ['Paris'])
+        self.assertEqual(self.ipa_cache.get(pespeak.get_espeak_version(), 'en-us', 'Paris'), b'paris')
+
+    def test_key_includes_voice_and_version(self):
+        manager = EspeakProcessManager()
+        self.ipa_cache.put('eSpeak 1.0', 'en-us', 'Paris', b'other version')
+        self.ipa_cache.put(pespeak.get_espeak_version(), 'de', 'Paris', b'other voice')
+        self.assertEqual(manager.to_ipa_for_language('Paris', 'en-us'), 'ˈpæɹɪs'.encode('utf8'))
+        self.assertEqual(manager.to_ipa_batch(['Paris'], 'de'), [b'other voice'])
+        self.assertEqual(manager.to_ipa_batch(['Paris'], 'es'), [b'\xcb\x88paris'])
+
+
+class RetiredProcessTestCase(FakeEspeakTestCase):
+
+    def test_evicted_process_is_not_respawned(self):
+        pool = EspeakProcessPool(max_children=2, always_online_languages=['en-us'], idle_timeout=None)
+        self.addCleanup(pool.close)
+        de = pool.get_process('de')
+        pool.get_process('es')
+        self.assertTrue(de.retired and de.closed)
+        self.assertRaises(pexpect.EOF, de.to_ipa, 'Berlin')
+        de.check()
+        self.assertTrue(de.closed)
+
+    def test_manager_asks_the_new_process(self):
+        pool = EspeakProcessPool(max_children=2, always_online_languages=['en-us'], idle_timeout=None)
+        self.addCleanup(pool.close)
+        de = pool.get_process('de')
+        pool.get_process('es')  # de is evicted after it was got by the manager
+        with mock.patch.object(EspeakProcessManager, 'pool', pool), \
+                mock.patch.object(pool, 'get_process', side_effect=[de, pool.get_process('de')]):
+            self.assertEqual(EspeakProcessManager().to_ipa_for_language('Berlin', 'de'), 'ˈberlin'.encode('utf8'))
+
+
+class PoolSpawnTestCase(FakeEspeakTestCase):
+
+    def test_spawn_outside_lock(self):
+        pool = EspeakProcessPool(max_children=3, always_online_languages=['en-us'], idle_timeout=None)
+        self.addCleanup(pool.close)
+        started, release = threading.Event(), threading.Event()
+        spawn = pespeak.EspeakProcess
+
+        def slow_spawn(language):
+            if language == 'de':
+                started.set()
+                release.wait(5)
+            return spawn(language)
+
+        with mock.patch.object(pespeak, 'EspeakProcess', side_effect=slow_spawn), ThreadPoolExecutor(2) as executor:
+            de = [executor.submit(pool.get_process, 'de') for _ in range(2)]
+            self.assertTrue(started.wait(5))
+            pool.get_process('es')  # Not blocked by espeak of de which is starting
+            self.assertFalse(de[0].done() or de[1].done())
+            release.set()
+            self.assertIs(de[0].result(), de[1].result())
+        self.assertEqual(pool.stats()['spawns'], 2)
+
+
+class AsyncEspeakTestCase(FakeEspeakTestCase):
+
+    def run_pool(self, run):
+        async def run_and_close():
+            pool = AsyncEspeakPool(children_per_language=1)
+            try:
+                return await run(pool)
+            finally:
+                await pool.close()
+
+        return asyncio.run(run_and_close())
+
+    def test_word_without_answer(self):
+        async def run(pool):
+            return await asyncio.gather(*[pool.to_ipa(word, 'en-us') for word in ['London', '\t', 'Paris']],
+                                        return_exceptions=True)
+
+        london, blank, paris = self.run_pool(run)
+        self.assertEqual((london, paris), ('ˈlʌndən'.encode('utf8'), 'ˈpæɹɪs'.encode('utf8')))
+        self.assertIsInstance(blank, EspeakError)
+
+    @mock.patch.object(pespeak, 'ESPEAK_TIMEOUT', 0.5)
+    def test_timeout(self):
+        async def run(pool):
+            await pool.to_ipa('London', 'en-us')
+            process, = await pool._get_processes('en-us')
+            os.kill(process._process.pid, signal.SIGSTOP)  # espeak hangs
+            results = await asyncio.gather(pool.to_ipa('Paris', 'en-us'), pool.to_ipa('James', 'en-us'),
+                                           return_exceptions=True)
+            self.assertTrue(process.closed)
+            return results, await pool.to_ipa('Paris', 'en-us')  # by a new process
+
+        (paris, james), ipa = self.run_pool(run)
+        self.assertIsInstance(paris, EspeakError)
+        self.assertIsInstance(james, EspeakError)
+        self.assertEqual(ipa, 'ˈpæɹɪs'.encode('utf8'))
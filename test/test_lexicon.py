@@ -0,0 +1,46 @@
+import io
+import os
+from unittest import mock
+
+from ppat import lexicon
+from ppat.lexicon import Lexicon, compile_lexicon, load_lexicon, parse_dict
+from ppat.ppat import LEXICON_PHONETICS, RulesManager
+from test import TemporaryCachesTestCase
+
+
+class LexiconTestCase(TemporaryCachesTestCase):
+
+    def test_parse_dict(self):
+        dict_file = io.StringIO('// comment\n\nLondon = 伦敦\nCharles = 查理 | 查尔斯\n')
+        self.assertEqual(parse_dict(dict_file), {'london': ('伦敦', '伦敦'), 'charles': ('查理', '查尔斯')})
+
+    def test_get(self):
+        entries = {word: (word.upper(), word) for word in ('b', 'a', 'd', 'ä', 'c')}
+        lex = Lexicon(compile_lexicon(entries, '0' * 40))
+        self.assertEqual(len(lex), 5)
+        for word in entries:
+            self.assertEqual(lex.get(word), entries[word])
+        self.assertEqual(lex.get('Ä'), ('Ä', 'ä'))
+        self.assertIsNone(lex.get('e'))
+        self.assertIsNone(Lexicon(compile_lexicon({}, '0' * 40)).get('a'))
+
+    def test_load_lexicon(self):
+        dict_path = os.path.join(self.cache_dir, 'xx.dict')
+        with open(dict_path, 'w', encoding='utf8') as f:
+            f.write('Wien = 维也纳\n')
+        with mock.patch.object(lexicon, 'LEXICON_CACHE_DIR', self.cache_dir):
+            self.assertIsNone(load_lexicon(os.path.join(self.cache_dir, 'yy.dict'), 'yy'))
+            self.assertEqual(load_lexicon(dict_path, 'xx').get('wien'), ('维也纳', '维也纳'))
+            self.assertTrue(os.path.exists(lexicon.get_lexicon_cache_path('xx')))
+            with open(dict_path, 'a', encoding='utf8') as f:
+                f.write('Köln = 科隆\n')
+            self.assertEqual(load_lexicon(dict_path, 'xx').get('Köln'), ('科隆', '科隆'))  # compiled again
+
+    def test_transliterate(self):
+        rule_manager = RulesManager()
+        self.assertEqual(rule_manager.transliterate('London', 'en-us'),
+                         (LEXICON_PHONETICS, '伦敦', LEXICON_PHONETICS, '伦敦'))
+        self.assertEqual(rule_manager.transliterate_batch(['Charles'], 'en-us'),
+                         [(LEXICON_PHONETICS, '查理', LEXICON_PHONETICS, '查尔斯')])
+        self.assertNotIn('en-us', rule_manager.rules)  # neither espeak nor the rules are needed
+        self.assertIsNone(rule_manager.lookup('Madrid', 'es'))
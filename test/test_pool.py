@@ -0,0 +1,70 @@
+import unittest
+from unittest import mock
+
+from ppat import pespeak
+from ppat.pespeak import EspeakProcessPool, _LFUOrder, _LRUOrder
+
+
+class FakeEspeakProcess(object):
+
+    def __init__(self, language):
+        self.language = language
+        self.last_used = 0
+        self.respawns = 0
+        self.retired = False
+        self.closed = False
+
+    def retire(self):
+        self.retired = True
+
+    def close(self):
+        self.closed = True
+
+
+class EvictionOrderTestCase(unittest.TestCase):
+
+    def test_lru(self):
+        order = _LRUOrder()
+        for key in 'abc':
+            order.add(key)
+        order.touch('a')
+        self.assertEqual(order.pop(), 'b')
+        order.remove('c')
+        self.assertEqual(order.pop(), 'a')
+
+    def test_lfu(self):
+        order = _LFUOrder()
+        for key in 'abc':
+            order.add(key)
+        order.touch('a')
+        order.touch('a')
+        order.touch('b')
+        self.assertEqual(order.pop(), 'c')
+        order.add('d')
+        self.assertEqual(order.pop(), 'd')
+        order.remove('b')
+        self.assertEqual(order.pop(), 'a')
+
+
+@mock.patch.object(pespeak, 'EspeakProcess', FakeEspeakProcess)
+class EspeakProcessPoolTestCase(unittest.TestCase):
+
+    def test_eviction(self):
+        pool = EspeakProcessPool(max_children=3, always_online_languages=['en-us'], idle_timeout=None)
+        en, de = pool.get_process('en-us'), pool.get_process('de')
+        fr = pool.get_process('fr')
+        pool.get_process('de')
+        pool.get_process('it')  # fr is the least recently used one
+        self.assertTrue(fr.retired and fr.closed)
+        self.assertFalse(de.closed)
+        self.assertEqual(pool.stats()['evictions'], 1)
+        self.assertIs(pool.get_process('en-us'), en)
+        self.assertEqual((pool.hits, pool.misses, pool.spawns), (2, 4, 4))
+
+    def test_reap_idle(self):
+        pool = EspeakProcessPool(max_children=3, always_online_languages=['en-us'], idle_timeout=60)
+        pool._start_reaper = lambda: None
+        en, de = pool.get_process('en-us'), pool.get_process('de')
+        self.assertEqual(pool.reap_idle(), 1)
+        self.assertTrue(de.closed)
+        self.assertFalse(en.closed)
@@ -0,0 +1,321 @@
+import io
+import json
+import os
+import pickle
+import re
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from ppat import ppat
+from ppat.ppat import PPAT, MatchRule, MatchTrie, Substitutions, TransliterationGrid, RulesManager, \
+    transliterate_many, get_batch_writer, read_batch_words, BATCH_FIELDS, FALLBACK_MARKER, MissingCoordError, \
+    NoMatchError, write_failures
+from test import TemporaryCachesTestCase
+
+
+class MatchRuleTestCase(unittest.TestCase):
+
+    def test_check_postfix(self):
+        rule = MatchRule(1, None, 'ən', '^[b|d]', 2)
+        self.assertTrue(rule.check('fənbə', 1, 3))
+        self.assertFalse(rule.check('fənəb', 1, 3))
+        rule = MatchRule(1, None, 'ən', '^$', 2)
+        self.assertTrue(rule.check('fən', 1, 3))
+        self.assertFalse(rule.check('fənə', 1, 3))
+        rule = MatchRule(1, None, 'ən', '^b|d', 2)  # "^" applies to both branches
+        self.assertTrue(rule.check('fəndə', 1, 3))
+        self.assertFalse(rule.check('fənəd', 1, 3))
+
+    def test_check_prefix(self):
+        rule = MatchRule(1, 'f$', 'ən', None, 2)
+        self.assertTrue(rule.check('fən', 1, 3))
+        self.assertFalse(rule.check('fbən', 2, 4))
+        self.assertFalse(rule.check('bənf', 1, 3))
+        rule = MatchRule(1, 'f|v', 'ən', None, 2)  # ends where <match> begins, even without "$"
+        self.assertTrue(rule.check('bvən', 2, 4))
+        self.assertFalse(rule.check('fbən', 2, 4))
+
+    def test_prefix_window(self):
+        self.assertEqual(MatchRule(1, 'f|vb', 'ən', None, 2).prefix_width, 2)
+        rule = MatchRule(1, 'b+', 'ən', None, 2)
+        self.assertIsNone(rule.prefix_width)
+        self.assertTrue(rule.check('abbbən', 4, 6))
+        rule = MatchRule(1, '^f', 'ən', None, 2)  # "^" is still the beginning of the phonetics
+        self.assertTrue(rule.check('fən', 1, 3))
+        self.assertFalse(rule.check('bfən', 2, 4))
+        rule = MatchRule(1, '(?<=a)f', 'ən', None, 2)  # a lookbehind still sees before the window
+        self.assertTrue(rule.check('afən', 2, 4))
+        self.assertFalse(rule.check('bfən', 2, 4))
+
+    def test_compact(self):
+        rule = MatchRule(1, 'f$', 'ən', '^[b|d]', 2)
+        self.assertFalse(hasattr(rule, '__dict__'))
+        other = pickle.loads(pickle.dumps(MatchRule(2, 'f$', 'ə' + 'n', None, 3)))
+        self.assertIs(other.match, rule.match)
+        self.assertIs(other.prefix_pattern, rule.prefix_pattern)
+
+    def test_prune_shadowed(self):
+        plain = MatchRule(1, None, 'b', None, 2)
+        after_m = MatchRule(2, 'm$', 'b', None, 3)
+        before_r = MatchRule(3, None, 'b', '^r', 4)
+        self.assertTrue(plain.shadows(after_m))
+        self.assertFalse(after_m.shadows(before_r))
+        self.assertEqual(MatchRule.prune_shadowed([after_m, before_r]), ((after_m, before_r), []))
+        both = MatchRule(4, 'm$', 'b', '^r', 5)
+        self.assertEqual(MatchRule.prune_shadowed([both, before_r, after_m]), ((after_m, before_r), [(both, after_m)]))
+        self.assertEqual(MatchRule.prune_shadowed([before_r, plain]), ((plain,), [(before_r, plain)]))
+
+
+class MatchTrieTestCase(unittest.TestCase):
+
+    def test_prefixes(self):
+        rules = {match: [MatchRule(i + 1, None, match, None, i + 2)] for i, match in enumerate(['t', 'tʃ', 'tʃi', 'ʃ'])}
+        trie = MatchTrie(rules)
+        self.assertEqual([(length, rule_list[0].match) for length, rule_list in trie.prefixes('atʃə', 1)],
+                         [(1, 't'), (2, 'tʃ')])
+        self.assertEqual(trie.prefixes('atʃə', 0), [])
+        self.assertEqual(trie.prefixes('atʃə', 4), [])
+        self.assertEqual(trie.max_length, 3)
+        self.assertEqual((trie.prefix_width, trie.postfix_width), (0, 0))
+
+    def test_context_widths(self):
+        trie = MatchTrie({'t': [MatchRule(1, None, 't', '^$', 2), MatchRule(2, 'ab|c', 't', '^ə', 3)]})
+        self.assertEqual((trie.prefix_width, trie.postfix_width), (3, 2))
+        self.assertIsNone(MatchTrie({'t': [MatchRule(1, None, 't', 'ə', 2)]}).postfix_width)  # anywhere after
+        self.assertIsNone(MatchTrie({'t': [MatchRule(1, 'a+', 't', None, 2)]}).prefix_width)
+        self.assertIsNone(MatchTrie({'t': [MatchRule(1, '(?<=a)b', 't', None, 2)]}).prefix_width)
+
+
+class TransliterationGridTestCase(unittest.TestCase):
+
+    def test_get(self):
+        grid = TransliterationGrid({(1, 2): '阿', (2, 1): '布', (2, 2): '巴'})
+        self.assertEqual(grid.get(2, 2), '巴')
+        self.assertIsNone(grid.get(1, 1))
+        self.assertIsNone(grid.get(3, 2))
+
+    def test_unused_coords(self):
+        grid = TransliterationGrid({(1, 2): '阿', (2, 1): '布', (3, 2): '巴'})
+        self.assertEqual(grid.unused_coords([2], [2]), [(3, 2)])
+
+    def test_missing_coords(self):
+        grid = TransliterationGrid({(1, 2): '阿', (2, 1): '布', (2, 2): '巴'})
+        self.assertEqual(grid.missing_coords([2, 3], [2]), [(3, 1), (3, 2)])
+
+
+class SubstitutionsTestCase(unittest.TestCase):
+
+    def test_apply(self):
+        substitutions = Substitutions([('海$', '亥'), ('^东', '栋'), ('代', '德'), ('代尔', '戴尔')])
+        self.assertEqual(substitutions.apply('东海'), '栋亥')
+        self.assertEqual(substitutions.apply('海东'), '海东')
+        self.assertEqual(substitutions.apply('代代尔代'), '德戴尔德')
+        self.assertEqual(Substitutions([]).apply('东海'), '东海')
+
+
+class RulesManagerTestCase(TemporaryCachesTestCase):
+
+    def setUp(self):
+        super(RulesManagerTestCase, self).setUp()
+        self.rule_manager = RulesManager()
+
+    def test_lazy_loading(self):
+        rule_manager = RulesManager()
+        self.assertEqual(rule_manager.rules, {})
+        self.assertIn('es', rule_manager.get_supported_languages())
+        rule_manager.transliterate('Madrid', 'es')
+        self.assertEqual(list(rule_manager.rules.keys()), ['es'])
+
+    def test_hans_cache(self):
+        rule_manager = RulesManager()
+        hans = rule_manager.to_hans('madrid', 'es', 'people')
+        self.assertEqual(hans, '马(玛)德里(丽)德')
+        self.assertIn(('es', 'people', 'madrid'), rule_manager.hans_cache)
+        self.assertGreater(len(rule_manager.segment_cache), 0)
+        rule_manager.hans_cache.clear()
+        self.assertEqual(rule_manager.to_hans('madrid', 'es', 'people'), hans)  # from the segment cache
+
+    def test_segment_cache_with_contexts(self):
+        # "ən" before a consonant, before a vowel or at the end is matched by different rules of en-us
+        phonetics = ['lʌndən', 'lʌndənbɜːɡ', 'ænən', 'ænənæ', 'dʒɑːnsən', 'dʒɑːnsənvɪl', 'hæmən', 'hæmənd'] * 2
+        uncached = RulesManager()
+        for trie in uncached.get_rule('en-us').match_tries.values():
+            trie.postfix_width = None  # Segments are not cached
+        expected = [uncached.to_hans(i, 'en-us', 'people') for i in phonetics]
+        self.assertEqual(len(uncached.segment_cache), 0)
+        rule_manager = RulesManager()
+        self.assertEqual([rule_manager.to_hans(i, 'en-us', 'people') for i in phonetics], expected)
+        self.assertGreater(len(rule_manager.segment_cache), 0)
+        rule_manager.hans_cache.clear()
+        with mock.patch.object(rule_manager, '_next_han', side_effect=AssertionError('segment cache missed')):
+            self.assertEqual([rule_manager.to_hans(i, 'en-us', 'people') for i in phonetics], expected)
+
+    def test_shared_by_threads(self):
+        rule_manager = RulesManager()
+        words = ['Madrid', 'Sevilla', 'Valencia', 'Barcelona', 'Toledo', 'Fernando'] * 20
+        expected = [self.rule_manager.transliterate(word, 'es') for word in words]
+        with ThreadPoolExecutor(8) as executor:
+            self.assertEqual(list(executor.map(lambda word: rule_manager.transliterate(word, 'es'), words)), expected)
+
+    def test_transliterate_batch(self):
+        words = ['Madrid', 'Sevilla', 'Valencia']
+        self.assertEqual(self.rule_manager.transliterate_batch(words, 'es'),
+                         [self.rule_manager.transliterate(word, 'es') for word in words])
+
+    def test_transliterate(self):
+        self.assertEqual(self.rule_manager.transliterate('Madrid', 'es'),
+                         ('madrid', '马(玛)德里(丽)德', 'madrid', '马(玛)德里(丽)德'))
+        self.assertEqual(self.rule_manager.transliterate('Juan', 'es'), ('juan', '胡安', 'juan', '胡安'))
+
+    def test_transliteration_errors(self):
+        with self.assertRaises(NoMatchError) as context:
+            self.rule_manager.to_hans('ma#', 'es', 'people')
+        self.assertEqual(context.exception.position, 2)
+        self.assertEqual(pickle.loads(pickle.dumps(context.exception)).phonetics, 'ma#')
+        self.assertEqual(self.rule_manager.to_hans('ma#', 'es', 'people', fallback='?'), '马(玛)?')
+        # (7, 1) is missing in the places table of es
+        self.assertRaises(MissingCoordError, self.rule_manager.to_hans, 'burgundy', 'es', 'places')
+
+    def test_iter_transliterate(self):
+        results = self.rule_manager.iter_transliterate(iter(['Madrid', 'Juan', 'Toledo']), ['es'], batch_size=2)
+        self.assertEqual(next(results), ('Madrid', 'es') + self.rule_manager.transliterate('Madrid', 'es'))
+        self.assertEqual([result.hans_places for result in results],
+                         ['胡安', self.rule_manager.transliterate('Toledo', 'es')[3]])
+
+    def test_post_process(self):
+        rule_manager = RulesManager()
+        rule_manager.hans_cache.put(('es', 'people', 'fa'), '夫阿')
+        self.assertEqual(rule_manager.transliterate_batch(['Fa'], 'es'), [('fa', '弗阿', 'fa', '法')])
+        self.assertEqual(rule_manager.to_hans('fa', 'es', 'people'), '夫阿')
+
+    def test_lint(self):
+        # "b | v = 2" at line 28 of es.rule shadows "v | w | b = 12" at line 38
+        rule = self.rule_manager.get_rule('es')
+        self.assertEqual([i.line_number for i in rule.consonants_people['b']], [28])
+        self.assertIn('es.rule:38: "b" in .consonants people is shadowed by line 28', '\n'.join(rule.lint()))
+
+    def test_failures(self):
+        failures = []
+        results = self.rule_manager.transliterate_batch(['Juan', 'Burgundy'], 'es', failures)
+        self.assertEqual(results[0], ('juan', '胡安', 'juan', '胡安'))
+        self.assertIn(FALLBACK_MARKER, results[1][3])
+        self.assertEqual([(i.word, i.category) for i in failures], [('Burgundy', 'places')])
+
+
+class TransliterateManyTestCase(TemporaryCachesTestCase):
+
+    def test_transliterate_many(self):
+        rule_manager = RulesManager()
+        words = ['Madrid', 'Sevilla', 'Valencia', 'Barcelona', 'Toledo', 'Fernando', 'Juan']
+        results = transliterate_many(words, ['es'], workers=2, chunk_size=2)
+        self.assertEqual(results, [{'es': rule_manager.transliterate(word, 'es')} for word in words])
+
+
+class RuleCacheTestCase(TemporaryCachesTestCase):
+
+    def test_load_rule(self):
+        file_path = ppat.get_rule_file_path('es')
+        parsed = ppat.load_rule(file_path)
+        cached = ppat.load_rule(file_path)
+        self.assertIsNot(parsed, cached)
+        self.assertEqual(cached.language_code, 'es')
+        self.assertEqual(cached.transliteration_people, parsed.transliteration_people)
+        self.assertEqual(cached.to_phonetics_people('Madrid'), 'madrid')
+        self.assertEqual(cached.substitutions, parsed.substitutions)
+        self.assertEqual(cached.post_process('夫', 'places'), '弗')
+
+
+class ReloadTestCase(TemporaryCachesTestCase):
+
+    def setUp(self):
+        super(ReloadTestCase, self).setUp()
+        self.rules_dir = ppat.RULES_DIR
+        ppat.RULES_DIR = os.path.join(tempfile.mkdtemp(), 'rules')
+        shutil.copytree(self.rules_dir, ppat.RULES_DIR)
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(ppat.RULES_DIR))
+        ppat.RULES_DIR = self.rules_dir
+
+    def test_reload(self):
+        rule_manager = RulesManager()
+        self.assertEqual(rule_manager.transliterate('Juan', 'es')[1], '胡安')
+        self.assertEqual(rule_manager.changed_languages(), [])
+        file_path = ppat.get_rule_file_path('es')
+        with open(file_path, encoding='utf8') as f:
+            text = f.read()
+        with open(file_path, 'w', encoding='utf8') as f:
+            f.write(text.replace('胡', '户'))
+        os.utime(file_path, ns=(0, 0))
+        self.assertEqual(rule_manager.changed_languages(), ['es'])
+        self.assertEqual(rule_manager.reload(), ['es'])
+        self.assertEqual(rule_manager.changed_languages(), [])
+        self.assertEqual(rule_manager.transliterate('Juan', 'es')[1], '户安')  # not from the hans cache
+
+        with open(file_path, 'w', encoding='utf8') as f:
+            f.write(text + '\n.meta\n')  # a duplicated section
+        rule = rule_manager.get_rule('es')
+        self.assertRaises(AssertionError, rule_manager.reload, 'es')
+        self.assertIs(rule_manager.get_rule('es'), rule)
+
+        with open(file_path, 'w', encoding='utf8') as f:
+            f.write(text + '\n.unknown\n')
+        self.assertRaisesRegex(AssertionError, 'Unknown section ".unknown"', rule_manager.reload, 'es')
+        self.assertIs(rule_manager.get_rule('es'), rule)
+
+
+class BatchTestCase(TemporaryCachesTestCase):
+
+    def test_read_batch_words(self):
+        input_file = io.StringIO('Roma\n\n# comment\n  Milano  \n')
+        self.assertEqual(list(read_batch_words(input_file)), [(1, 'Roma'), (4, 'Milano')])
+
+    def test_tsv_writer(self):
+        output_file = io.StringIO()
+        write = get_batch_writer(output_file, 'tsv')
+        write(['a', 'b', 'c', 'd', 'e', 'f'])
+        self.assertEqual(output_file.getvalue(), '\t'.join(BATCH_FIELDS) + '\na\tb\tc\td\te\tf\n')
+
+    def test_jsonl_writer(self):
+        output_file = io.StringIO()
+        write = get_batch_writer(output_file, 'jsonl')
+        write(['a', 'b', 'c', 'd', 'e', 'f'])
+        self.assertEqual(json.loads(output_file.getvalue()), dict(zip(BATCH_FIELDS, 'abcdef')))
+
+    def test_yml_writer(self):
+        output_file = io.StringIO()
+        write = get_batch_writer(output_file, 'yml')
+        write(['Juan', 'es', 'juan', '胡安', 'juan', '胡安'])
+        self.assertEqual(output_file.getvalue(), 'l_english:\n Juan_people:0 "胡安" # es\n Juan_places:0 "胡安" # es\n')
+
+    def test_yml_writer_escape(self):
+        output_file = io.StringIO()
+        write = get_batch_writer(output_file, 'yml')
+        word, hans = 'O"Bri\\en', '奥"布\\赖恩'
+        write([word, 'en-us', '', hans, '', hans])
+        lines = output_file.getvalue().splitlines()[1:]
+        pattern = re.compile(r' ("(?:[^"\\]|\\.)*"):0 ("(?:[^"\\]|\\.)*") # en-us\Z')
+        self.assertEqual([tuple(json.loads(i) for i in pattern.match(line).groups()) for line in lines],
+                         [(word + '_people', hans), (word + '_places', hans)])
+
+    def test_batch(self):
+        ppat = PPAT()
+        output_file = io.StringIO()
+        count = ppat.batch(io.StringIO('Madrid\nSan Sebastian\nSevilla\n'), output_file, 'jsonl', ['es'])
+        self.assertEqual(count, 2)
+        rows = [json.loads(line) for line in output_file.getvalue().splitlines()]
+        self.assertEqual([row['word'] for row in rows], ['Madrid', 'Sevilla'])
+        self.assertTrue(all(row['language'] == 'es' and row['hans_people'] for row in rows))
+
+    def test_batch_failures(self):
+        ppat = PPAT()
+        failures = []
+        count = ppat.batch(io.StringIO('Burgundy\nMadrid\n'), io.StringIO(), 'tsv', ['es'], failures=failures)
+        self.assertEqual(count, 2)
+        report = io.StringIO()
+        write_failures(failures, report)
+        report.seek(0)
+        self.assertEqual(list(read_batch_words(report)), [(2, 'Burgundy')])
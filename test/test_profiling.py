@@ -0,0 +1,33 @@
+
+from ppat.ppat import RulesManager
+from ppat.profiling import Profiler, profiler
+from test import TemporaryCachesTestCase
+
+
+class ProfilerTestCase(TemporaryCachesTestCase):
+
+    def tearDown(self):
+        profiler.enabled = False
+        profiler.reset()
+
+    def test_disabled(self):
+        local_profiler = Profiler()
+        with local_profiler.stage('to_hans', 'es'):
+            pass
+        self.assertEqual(local_profiler.stages, {})
+
+    def test_merge(self):
+        local_profiler = Profiler()
+        local_profiler.add_time(('es', 'to_hans'), 0.5)
+        local_profiler.count(('es', 'segments'), 3)
+        local_profiler.merge(local_profiler.snapshot())
+        self.assertEqual(local_profiler.stages[('es', 'to_hans')], [2, 1.0])
+        self.assertEqual(local_profiler.counters[('es', 'segments')], 6)
+
+    def test_transliterate(self):
+        profiler.enabled = True
+        RulesManager().transliterate('Madrid', 'es')
+        self.assertEqual(profiler.stages[('es', 'transliterate')][0], 1)
+        self.assertEqual(profiler.stages[('es', 'to_hans')][0], 2)
+        self.assertGreater(profiler.counters[('es', 'candidates')], 0)
+        self.assertIn('candidates per segment', profiler.report())
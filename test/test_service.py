@@ -0,0 +1,113 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+from unittest import mock
+
+from ppat.ppat import FALLBACK_MARKER, RulesManager
+from ppat.pespeak import AsyncEspeakPool, EspeakError
+from ppat.service import Service
+from test import TemporaryCachesTestCase
+from test.test_espeak import FakeEspeakTestCase
+
+
+class ServiceTestCase(TemporaryCachesTestCase):
+
+    def setUp(self):
+        super(ServiceTestCase, self).setUp()
+        self.service = Service(RulesManager(), AsyncEspeakPool(), languages=['es'], quiet=True)
+
+    def request(self, method, path, body=None):
+        async def run():
+            server = await asyncio.start_server(self.service.handle_connection, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            data = json.dumps(body).encode('utf8') if body is not None else b''
+            writer.write('{} {} HTTP/1.1\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'
+                         .format(method, path, len(data)).encode('latin-1') + data)
+            response = await reader.read()
+            writer.close()
+            server.close()
+            await server.wait_closed()
+            return response
+
+        head, _, body = asyncio.run(run()).partition(b'\r\n\r\n')
+        return int(head.split()[1]), json.loads(body.decode('utf8'))
+
+    def test_transliterate(self):
+        status, response = self.request('POST', '/transliterate', {'words': ['Madrid', 'Juan']})
+        self.assertEqual(status, 200)
+        self.assertEqual([(i['word'], i['language'], i['hans_people']) for i in response['results']],
+                         [('Madrid', 'es', '马(玛)德里(丽)德'), ('Juan', 'es', '胡安')])
+
+    def test_bad_request(self):
+        self.assertEqual(self.request('POST', '/transliterate', {'word': 'San Sebastian'})[0], 400)
+        for word in ['', 'Juan\t', '\tJuan', 'Ju\x00an', 'Ju\u2028an', 'Ju\u200ban']:
+            self.assertEqual(self.request('POST', '/transliterate', {'words': ['Madrid', word]})[0], 400)
+        self.assertEqual(self.request('POST', '/transliterate', {'word': 'Juan', 'languages': ['xx']})[0], 400)
+        self.assertEqual(self.request('GET', '/transliterate')[0], 405)
+        self.assertEqual(self.request('GET', '/nothing')[0], 404)
+
+    def test_stats(self):
+        self.request('POST', '/transliterate', {'word': 'Juan'})
+        status, response = self.request('GET', '/stats')
+        self.assertEqual(status, 200)
+        self.assertEqual(response['words'], 1)
+        self.assertIn('es', response['loaded_languages'])
+
+    def test_load_languages(self):
+        self.request('POST', '/transliterate', {'word': 'Roma', 'languages': ['it']})
+        self.assertIn('it', self.service.rule_manager.rules)
+        self.assertIn('it', self.service.rule_manager.lexicons)
+
+    def test_serve(self):
+        unix_socket = os.path.join(self.cache_dir, 'ppat.sock')
+
+        async def run():
+            serving = asyncio.create_task(self.service.serve(unix_socket=unix_socket))
+            while not os.path.exists(unix_socket):
+                await asyncio.sleep(0.01)
+            reader, writer = await asyncio.open_unix_connection(unix_socket)
+            writer.write(b'GET /languages HTTP/1.1\r\nConnection: close\r\n\r\n')
+            response = await reader.read()
+            writer.close()
+            serving.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await serving
+            return response
+
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertTrue(asyncio.run(run()).startswith(b'HTTP/1.1 200 OK'))
+
+
+class EspeakServiceTestCase(FakeEspeakTestCase):
+
+    def setUp(self):
+        super(EspeakServiceTestCase, self).setUp()
+        self.rule_manager = RulesManager()
+        self.rule_manager.lexicons['en-us'] = None  # Words go to espeak instead of the override dictionary
+        self.service = Service(self.rule_manager, AsyncEspeakPool(), languages=['en-us'], quiet=True)
+
+    def transliterate(self, request):
+        async def run():
+            try:
+                return await self.service.transliterate(json.dumps(request).encode('utf8'))
+            finally:
+                await self.service.espeak_pool.close()
+
+        return asyncio.run(run())
+
+    def test_transliterate(self):
+        response = self.transliterate({'words': ['London', 'Paris']})
+        self.assertEqual([(i['word'], i['phonetics_people'], i['hans_people']) for i in response['results']],
+                         [(word,) + self.rule_manager.transliterate(word, 'en-us')[:2] for word in ['London', 'Paris']])
+        self.assertEqual(response['failures'], [])
+
+    def test_espeak_error(self):
+        with mock.patch.object(AsyncEspeakPool, 'to_ipa', side_effect=EspeakError('espeak hung')):
+            response = self.transliterate({'word': 'London'})
+        self.assertEqual([(i['phonetics_people'], i['hans_people']) for i in response['results']],
+                         [('', FALLBACK_MARKER)])
+        self.assertEqual([(i['word'], i['category']) for i in response['failures']],
+                         [('London', 'people'), ('London', 'places')])